@@ -1,9 +1,15 @@
 """A CLI app script skeleton"""
 import argparse
+from collections import Counter
+import contextlib
+import cProfile
 import logging
 import logging.config
+import sys
 from textwrap import dedent
-from typing import List
+import threading
+import tracemalloc
+from typing import Callable, Iterator, List
 
 
 logger = logging.getLogger(__name__)
@@ -14,6 +20,133 @@ def main_subcommand_a(args) -> int:
     return 0
 
 
+class _Periodic(threading.Thread):
+    """Call ``func`` every ``interval`` seconds, and once more when stopped"""
+
+    def __init__(self, func: Callable[[], None], interval: float) -> None:
+        super().__init__(daemon=True)
+        self.func = func
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.func()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.join()
+        self.func()
+
+
+def _log_malloc_top(top: int) -> Callable[[], None]:
+    """Log the ``top`` lines which allocated the most since the last call"""
+    last: List[tracemalloc.Snapshot] = []
+
+    def _() -> None:
+        snapshot = tracemalloc.take_snapshot()
+        if last:
+            stats = snapshot.compare_to(last.pop(), 'lineno')
+        else:
+            stats = snapshot.statistics('lineno')
+        last.append(snapshot)
+        for stat in stats[:top]:
+            logger.info('%s', stat)
+
+    return _
+
+
+def _sample_stacks(stacks: Counter) -> Callable[[], None]:
+    """Count the stacks of the other threads in the flamegraph.pl format"""
+    def _() -> None:
+        current = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == current:
+                continue
+            stack: List[str] = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})')  # noqa: E501
+                frame = frame.f_back
+            stacks[';'.join(reversed(stack))] += 1
+
+    return _
+
+
+def _write_stacks(stacks: Counter, path: str) -> None:
+    with open(path, 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write(f'{stack} {count}\n')
+    logger.info('the stacks have been written: path=%s', path)
+
+
+def _dump_profile(profile: cProfile.Profile, path: str) -> None:
+    profile.disable()
+    profile.dump_stats(path)
+    logger.info('the profile has been written: path=%s', path)
+
+
+def _add_profiling_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--profile',
+        metavar='PATH',
+        help='write cProfile stats of the main thread to PATH on exit',
+    )
+    parser.add_argument(
+        '--trace-malloc',
+        metavar='N',
+        default=0,
+        type=int,
+        help='log the N lines which allocated the most at intervals',
+    )
+    parser.add_argument(
+        '--trace-malloc-interval',
+        metavar='SECONDS',
+        default=60.0,
+        type=float,
+    )
+    parser.add_argument(
+        '--profile-sample',
+        metavar='PATH',
+        help='sample the stacks of every thread at intervals into PATH',
+    )
+    parser.add_argument(
+        '--profile-sample-interval',
+        metavar='SECONDS',
+        default=0.01,
+        type=float,
+    )
+
+
+@contextlib.contextmanager
+def _profiling(args: argparse.Namespace) -> Iterator[None]:
+    """Run the profilers asked for by the options while in the context"""
+    with contextlib.ExitStack() as stack:
+        if args.trace_malloc > 0:
+            tracemalloc.start()
+            stack.callback(tracemalloc.stop)
+            tracer = _Periodic(
+                _log_malloc_top(args.trace_malloc),
+                args.trace_malloc_interval,
+            )
+            tracer.start()
+            stack.callback(tracer.stop)
+        if args.profile_sample is not None:
+            stacks: Counter = Counter()
+            stack.callback(_write_stacks, stacks, args.profile_sample)
+            sampler = _Periodic(
+                _sample_stacks(stacks),
+                args.profile_sample_interval,
+            )
+            sampler.start()
+            stack.callback(sampler.stop)
+        if args.profile is not None:
+            profile = cProfile.Profile()
+            stack.callback(_dump_profile, profile, args.profile)
+            profile.enable()
+        yield
+
+
 def _configure_logging(log_level: str) -> None:
     """Configure the logging facility"""
     logging.config.dictConfig({
@@ -50,6 +183,7 @@ def main(argv: List[str]) -> int:
         ),
     )
     parser.add_argument('--log-level', default='INFO')
+    _add_profiling_arguments(parser)
     subparsers = parser.add_subparsers(required=True)
 
     # sub command a
@@ -72,9 +206,9 @@ def main(argv: List[str]) -> int:
     args = parser.parse_args(argv or ['-h'])
     _configure_logging(log_level=args.log_level)
     logger.debug('given option: %s', vars(args))
-    return args.func(args)
+    with _profiling(args):
+        return args.func(args)
 
 
 if __name__ == '__main__':
-    import sys
     main(sys.argv[1:])
@@ -0,0 +1,431 @@
+"""Benchmark the event path of the suppressor offline
+
+Synthetic RTM payloads are fed to the RTM callbacks of a suppressor wired by
+:func:`main.wire_suppressor` or :func:`main.wire_suppressor_async`, i.e.
+through the same middlewares, scheduler and metrics, while a local HTTP
+server stands in for the Slack Web API and the web app endpoints, e.g.::
+
+  $ python bench.py --events 20000 --channels 5000 --rules 200
+  $ python bench.py --async -- --concurrency 16 --mark-window 0.5
+
+Options after ``--`` are passed to the ``suppress`` subcommand.
+"""
+import argparse
+import asyncio
+import collections
+import http.server
+import json
+import logging
+import random
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from typing import (
+    Any,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Tuple,
+)
+from urllib.parse import parse_qsl, urlparse
+
+import slack
+
+import main as app
+from scheduler import TIERS
+
+
+logger = logging.getLogger(__name__)
+
+SELF_ID = 'UBENCHSELF'
+UNREAD_REACTION = 'eyes'
+#: far above the rate limits of Slack, so that the scheduler costs only its
+#: own overhead
+UNLIMITED_TIERS = {tier: (60e6, 10 ** 6) for tier in TIERS}
+
+
+# Fake Slack
+# ==========
+
+class FakeSlack(http.server.ThreadingHTTPServer):
+    """A local stand-in for the Slack Web API and the web app endpoints"""
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, channels: int, usergroups: int) -> None:
+        super().__init__(('127.0.0.1', 0), FakeSlackHandler)
+        self.muted_channels = ','.join(
+            f'C{i}' for i in range(0, channels, 2)
+        )
+        self.usergroups = usergroups
+        self.calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def count(self, method: str) -> None:
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def respond(self, method: str, params: Dict[str, str]) -> Dict[str, Any]:
+        self.count(method)
+        if method == 'users.prefs.get':
+            return {
+                'ok': True,
+                'prefs': {'muted_channels': self.muted_channels},
+            }
+        elif method == 'usergroups.users.list':
+            # I am a member of every other usergroup
+            index = int(params.get('usergroup', 'S0')[1:])
+            users = ['U0', SELF_ID] if index % 2 == 0 else ['U0']
+            return {'ok': True, 'users': users}
+        else:
+            return {'ok': True}
+
+
+class FakeSlackHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    server: FakeSlack
+
+    def _handle(self) -> None:
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length).decode()
+            if self.headers.get('Content-Type', '').startswith(
+                'application/json'
+            ):
+                params.update(json.loads(body))
+            else:
+                params.update(parse_qsl(body))
+
+        method = url.path.rstrip('/').rsplit('/', 1)[-1]
+        content = json.dumps(self.server.respond(method, params)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = _handle
+    do_POST = _handle
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+# Workloads
+# =========
+
+def generate_rules(n: int) -> List[Dict[str, Any]]:
+    return [
+        {
+            'method': ['__contains__', 'startswith', 'endswith'][i % 3],
+            'arguments': [f'keyword{i}'],
+            'channel': 'CRULES',
+            'text': f'rule {i} matched',
+        }
+        for i in range(n)
+    ]
+
+
+def generate_events(
+    n: int,
+    channels: int,
+    usergroups: int,
+    rules: int,
+    seed: int,
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Yield ``(event type, data)`` of synthetic RTM events"""
+    rand = random.Random(seed)
+    ts = 1600000000 * 1000000
+    recent: List[Tuple[str, str]] = []
+    for _ in range(n):
+        ts += rand.randint(1, 100000)
+        channel = f'C{rand.randrange(channels)}'
+        kind = rand.random()
+
+        if kind < 0.05 and recent:
+            reacted_channel, reacted_ts = rand.choice(recent)
+            yield 'reaction_removed', {
+                'type': 'reaction_removed',
+                'user': SELF_ID,
+                'reaction': UNREAD_REACTION,
+                'item': {
+                    'type': 'message',
+                    'channel': reacted_channel,
+                    'ts': reacted_ts,
+                },
+                'event_ts': app.format_ts(ts),
+            }
+            continue
+
+        words = [f'word{rand.randrange(1000)}' for _ in range(20)]
+        if rules and rand.random() < 0.1:
+            words.append(f'keyword{rand.randrange(rules)}')
+        if usergroups and rand.random() < 0.2:
+            index = rand.randrange(usergroups)
+            words.append(f'<!subteam^S{index}|@group{index}>')
+        if rand.random() < 0.05:
+            words.append(f'<@{SELF_ID}>')
+
+        data = {
+            'type': 'message',
+            'channel': channel,
+            'user': SELF_ID if rand.random() < 0.1 else f'U{rand.randrange(500)}',  # noqa: E501
+            'text': ' '.join(words),
+            'ts': app.format_ts(ts),
+        }
+        if kind < 0.25:
+            parent = recent[-1][1] if recent else app.format_ts(ts)
+            data['thread_ts'] = parent
+        recent = (recent + [(channel, data['ts'])])[-100:]
+        yield 'message', data
+
+
+# Runners
+# =======
+
+def _account(
+    server: FakeSlack,
+    rules_conf: List[Dict[str, Any]],
+) -> app.Account:
+    return app.Account(
+        name='bench',
+        token='xoxp-bench',
+        web_app_cookie='d=bench',
+        web_app_token='xoxc-bench',
+        web_app_base_url=server.url,
+        get_prefs_interval=3600.0,
+        on_message_conf=rules_conf,
+        unread_reaction=UNREAD_REACTION,
+        read_reaction='white_check_mark',
+        time_card='https://example.com/',
+        dm_to_self='DBENCH',
+    )
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def run_sync(
+    argv: argparse.Namespace,
+    server: FakeSlack,
+    events: List[Tuple[str, Dict[str, Any]]],
+    rules_conf: List[Dict[str, Any]],
+) -> Tuple[float, List[float]]:
+    metrics = app.AppMetrics()
+    web_client = slack.WebClient(token='xoxp-bench', base_url=server.url + '/api/')  # noqa: E501
+    web_app_client = app.WebAppClient(
+        'd=bench', 'xoxc-bench', server.url,
+        pool_size=argv.web_app_pool_size,
+        timeout=argv.web_app_timeout,
+        metrics=metrics,
+    )
+    wiring = app.wire_suppressor(
+        argv,
+        _account(server, rules_conf),
+        asyncio.get_event_loop(),
+        metrics,
+        web_app_client,
+        tiers=UNLIMITED_TIERS,
+    )
+    callbacks = wiring.callbacks
+    wiring.effects.start()
+    callbacks['open'](
+        rtm_client=None,
+        web_client=web_client,
+        data={'self': {'id': SELF_ID}},
+    )
+
+    # the latency is from receiving an event until it is reduced and its
+    # side effects are handed to the effect thread
+    latencies = []
+    started_at = time.perf_counter()
+    for event, data in events:
+        t0 = time.perf_counter()
+        callbacks[event](rtm_client=None, web_client=web_client, data=data)
+        latencies.append(time.perf_counter() - t0)
+    wiring.effects.stop()
+    wiring.marks.flush()
+    wiring.scheduler.stop()
+    elapsed = time.perf_counter() - started_at
+
+    web_app_client.close()
+    return elapsed, latencies
+
+
+def run_async(
+    argv: argparse.Namespace,
+    server: FakeSlack,
+    events: List[Tuple[str, Dict[str, Any]]],
+    rules_conf: List[Dict[str, Any]],
+) -> Tuple[float, List[float]]:
+    async def _run() -> Tuple[float, List[float]]:
+        metrics = app.AppMetrics()
+        web_client = slack.WebClient(
+            token='xoxp-bench',
+            base_url=server.url + '/api/',
+            run_async=True,
+        )
+        web_app_client = app.AsyncWebAppClient(
+            'd=bench', 'xoxc-bench', server.url,
+            pool_size=argv.web_app_pool_size,
+            timeout=argv.web_app_timeout,
+            metrics=metrics,
+        )
+        wiring = app.wire_suppressor_async(
+            argv,
+            _account(server, rules_conf),
+            asyncio.get_event_loop(),
+            metrics,
+            web_app_client,
+            tiers=UNLIMITED_TIERS,
+        )
+        callbacks = wiring.callbacks
+        pipeline = wiring.effects
+
+        # the latency is from receiving an event until it is reduced and
+        # its side effects are scheduled; events are reduced in order
+        received_at: Deque[float] = collections.deque()
+        latencies = []
+
+        def _measure():
+            if received_at:
+                latencies.append(time.perf_counter() - received_at.popleft())
+
+        wiring.store.subscribe(_measure, app.ON_MESSAGE + app.ON_REACTION)
+
+        consumer = asyncio.ensure_future(pipeline.run())
+        wiring.scheduler.start()
+        callbacks['open'](
+            rtm_client=None,
+            web_client=web_client,
+            data={'self': {'id': SELF_ID}},
+        )
+        await pipeline.drain()
+
+        started_at = time.perf_counter()
+        for event, data in events:
+            received_at.append(time.perf_counter())
+            callbacks[event](
+                rtm_client=None,
+                web_client=web_client,
+                data=data,
+            )
+            # let the consumer run as if events came from a socket
+            await asyncio.sleep(0)
+        await pipeline.drain()
+        wiring.marks.flush()
+        await pipeline.drain()
+        await wiring.scheduler.close()
+        elapsed = time.perf_counter() - started_at
+
+        consumer.cancel()
+        await web_app_client.close()
+        return elapsed, latencies
+
+    return asyncio.get_event_loop().run_until_complete(_run())
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--events', default=10000, type=int)
+    parser.add_argument('--channels', default=1000, type=int)
+    parser.add_argument('--rules', default=50, type=int)
+    parser.add_argument('--usergroups', default=20, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--async', dest='run_async', action='store_true')
+    parser.add_argument(
+        '--trace-memory',
+        help=(
+            'measure the memory retained and at peak with tracemalloc, '
+            'which slows things down'
+        ),
+        action='store_true',
+    )
+    parser.add_argument(
+        '--json',
+        help='print the result as a JSON object',
+        action='store_true',
+    )
+    args, suppress_args = parser.parse_known_args(argv)
+    if suppress_args[:1] == ['--']:
+        suppress_args = suppress_args[1:]
+
+    logging.basicConfig(level=logging.WARNING)
+
+    suppress_argv = app.build_parser().parse_args([
+        'suppress',
+        '--state-log-level', 'DEBUG',
+        # a burst of synthetic events would overflow a queue sized for a
+        # live stream; given after --, a size is honoured to see the drops
+        '--effect-queue-size', '0',
+        *suppress_args,
+    ])
+    if args.run_async:
+        suppress_argv.run_async = True
+
+    server = FakeSlack(args.channels, args.usergroups)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    events = list(generate_events(
+        args.events, args.channels, args.usergroups, args.rules, args.seed,
+    ))
+
+    if args.trace_memory:
+        tracemalloc.start()
+    blocks_before = sys.getallocatedblocks()
+    run = run_async if suppress_argv.run_async else run_sync
+    elapsed, latencies = run(
+        suppress_argv, server, events, generate_rules(args.rules),
+    )
+    blocks_after = sys.getallocatedblocks()
+    server.shutdown()
+
+    result: Dict[str, Any] = {
+        'mode': 'async' if suppress_argv.run_async else 'sync',
+        'events': len(events),
+        'channels': args.channels,
+        'rules': args.rules,
+        'usergroups': args.usergroups,
+        'elapsed_s': elapsed,
+        'events_per_s': len(events) / elapsed,
+        'latency_p50_ms': _percentile(latencies, 0.50) * 1000,
+        'latency_p99_ms': _percentile(latencies, 0.99) * 1000,
+        'latency_mean_ms': (
+            statistics.mean(latencies) * 1000 if latencies else 0.0
+        ),
+        # blocks still allocated at the end; the ones allocated and freed
+        # while an event is handled are not counted
+        'retained_blocks_per_event': (
+            (blocks_after - blocks_before) / len(events) if events else 0.0
+        ),
+        'api_calls': dict(sorted(server.calls.items())),
+    }
+    if args.trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result['retained_traced_bytes_per_event'] = current / len(events)
+        result['traced_peak_bytes'] = peak
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for k, v in result.items():
+            print(f'{k:32} {v:.3f}' if isinstance(v, float) else f'{k:32} {v}')  # noqa: E501
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,167 @@
+"""An append-only journal of RTM events
+
+A journal is a file which starts with :data:`MAGIC` followed by records.
+A record is a 4 byte big endian length and that many bytes of compact JSON,
+``[time, event, data]``, e.g. ``[1589000000.1, "message", {...}]``.
+
+Every record is written to the file as soon as it is appended, so that it
+survives a crash of the process, while ``fsync`` is called once per batch,
+so that at most ``fsync_batch_size`` records or ``fsync_interval`` seconds
+of records are lost if the host goes down. The latter holds only while the
+journal is synced periodically, see :meth:`JournalWriter.sync_periodically`,
+as the last records of a burst would otherwise wait for the next append.
+
+A journal grows until it is rotated, i.e. moved to ``<path>.1`` and started
+over, which the suppressor does once a snapshot has made its records
+unnecessary for a restart.
+"""
+import asyncio
+import dataclasses
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from typing import (
+    Any,
+    Callable,
+    Iterator,
+    Optional,
+)
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'RTMJ\x00\x01'
+LENGTH = struct.Struct('>I')
+
+
+class JournalError(Exception):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class Record:
+    #: seconds since the epoch when the event was received
+    time: float
+    #: an RTM event type, e.g. ``message``
+    event: str
+    data: Any
+
+
+class JournalWriter:
+    """Append records to a journal"""
+
+    def __init__(
+        self,
+        path: str,
+        fsync_interval: float = 1.0,
+        fsync_batch_size: int = 100,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.fsync_batch_size = fsync_batch_size
+        self._clock = clock
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._open()
+
+    def _open(self) -> None:
+        self._file = open(self.path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+            self._file.flush()
+        self._pending = 0
+        self._synced_at = self._clock()
+
+    def append(self, event: str, data: Any) -> None:
+        body = json.dumps(
+            [time.time(), event, data],
+            ensure_ascii=False,
+            separators=(',', ':'),
+        ).encode('utf-8')
+        # a single write keeps a record whole even if another process
+        # appends to the same file
+        self._file.write(LENGTH.pack(len(body)) + body)
+        self._file.flush()
+        self._pending += 1
+        if (
+            self._pending >= self.fsync_batch_size or
+            self._clock() - self._synced_at >= self.fsync_interval
+        ):
+            self.sync()
+
+    def sync(self) -> None:
+        if self._pending:
+            os.fsync(self._file.fileno())
+            self._pending = 0
+        self._synced_at = self._clock()
+
+    def sync_periodically(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Sync every ``fsync_interval`` seconds on ``loop`` until closed
+
+        Records have to be appended on the thread of ``loop``.
+        """
+        self._handle = loop.call_later(
+            self.fsync_interval,
+            self._tick,
+            loop,
+        )
+
+    def _tick(self, loop: asyncio.AbstractEventLoop) -> None:
+        try:
+            self.sync()
+        except Exception:
+            logger.exception('failed to sync a journal: path=%s', self.path)
+        finally:
+            self.sync_periodically(loop)
+
+    def close(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._close_file()
+
+    def _close_file(self) -> None:
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def rotate(self) -> None:
+        """Move the records to ``<path>.1`` and start an empty journal"""
+        self._close_file()
+        os.replace(self.path, f'{self.path}.1')
+        self._open()
+
+
+def read_journal(path: str) -> Iterator[Record]:
+    """Yield the records of a journal in the appended order
+
+    A record cut off at the end, i.e. one being written when the process
+    died, is ignored.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if m[:len(MAGIC)] != MAGIC:
+                raise JournalError(f'not a journal: {path}')
+
+            offset = len(MAGIC)
+            size = len(m)
+            while offset + LENGTH.size <= size:
+                (length,) = LENGTH.unpack_from(m, offset)
+                start = offset + LENGTH.size
+                if start + length > size:
+                    break
+                t, event, data = json.loads(m[start:start + length])
+                yield Record(time=t, event=event, data=data)
+                offset = start + length
+
+            if offset != size:
+                logger.warning(
+                    'a truncated record is ignored: path=%s, offset=%d',
+                    path,
+                    offset,
+                )
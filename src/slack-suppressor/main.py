@@ -1,28 +1,77 @@
+from __future__ import annotations
+
 import argparse
-import copy
+import asyncio
+import concurrent.futures
 import dataclasses
 import datetime
 import enum
 import json
 import logging
 import logging.config
-from functools import wraps
-import pprint
+import multiprocessing
+from collections import Counter, OrderedDict
+from functools import partial, wraps
+import heapq
+import importlib.util
+import operator
+import os
+import queue
+import random
 import re
+import signal
+import sys
+import threading
+import time
 from typing import (
     Any,
+    Awaitable,
     Callable,
+    Collection,
     Dict,
-    Generic,
+    FrozenSet,
+    Iterable,
     List,
+    Mapping,
     Optional,
-    TypeVar,
+    Set,
+    Tuple,
     Union,
 )
 
-import slack
-from slack.web.slack_response import SlackResponse
-import requests
+import immutables
+
+from journal import JournalWriter, Record, read_journal
+from matcher import RuleMatcher
+from metrics import AppMetrics, MetricsServer
+import profiling
+from scheduler import TIERS, ApiScheduler, AsyncApiScheduler
+from snapshot import read_snapshot, write_snapshot
+
+
+def _lazy_import(name: str):
+    """Import a module when one of its attributes is first accessed
+
+    ``aiohttp``, ``slack`` and ``requests`` take most of the startup time,
+    and neither ``replay`` against the stubs nor ``--help`` uses them.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f'No module named {name!r}', name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+aiohttp = _lazy_import('aiohttp')
+slack = _lazy_import('slack')
+requests = _lazy_import('requests')
+tokenstore = _lazy_import('tokenstore')
 
 
 logger = logging.getLogger()
@@ -31,43 +80,85 @@ logger = logging.getLogger()
 # Common
 # ======
 
-T = TypeVar('T')
 R_SUBTEAM = re.compile(r'<!subteam\^([^|]+)\|@[^>]+>')
 
 
-class UncopiableProxy(Generic[T]):
-    __slots__ = ['_obj']
-
-    def __init__(self, obj: T):
-        self._obj = obj
+def _parse_cookie(cookie: str) -> Dict[str, str]:
+    """Parse a ``Cookie`` header value into a dict"""
+    return {
+        k.strip(): v.strip()
+        for k, v in
+        [c.split('=', 1) for c in cookie.split(';') if c.strip()]
+    }
 
-    def __getattr__(self, name):
-        return getattr(self._obj, name)
 
-    def __setattr__(self, name, value):
-        if name in self.__slots__:
-            return super().__setattr__(name, value)
-        else:
-            return setattr(self._obj, name, value)
+@dataclasses.dataclass(frozen=True)
+class WebAppResponse:
+    """A response of :class:`AsyncWebAppClient`
 
-    def __getitem__(self, name):
-        return self._obj.__getitem__(name)
+    It mimics the part of :class:`requests.Response` the subscribers use.
+    """
+    status_code: int
+    content: bytes
+    #: case-insensitive like the headers of :class:`requests.Response`
+    #: unless empty
+    headers: Mapping[str, str] = dataclasses.field(default_factory=dict)
 
-    def __setitem__(self, name, value):
-        return self._obj.__setitem__(name, value)
+    def json(self) -> Any:
+        return json.loads(self.content)
 
-    def __repr__(self):
-        return repr(self._obj)
 
-    def __deepcopy__(self, memo):
-        return UncopiableProxy(self._obj)
+class _BaseWebAppClient:
+    """Things shared between the web app clients
 
+    The cookie jar, the headers and the token are built once here and reused
+    by every request.
+    """
 
-class WebAppClient:
-    def __init__(self, cookie: str, token: str, base_url: str) -> None:
+    def __init__(
+        self,
+        cookie: str,
+        token: str,
+        base_url: str,
+        pool_size: int = 10,
+        timeout: float = 10.0,
+        headers: Optional[Dict[str, str]] = None,
+        metrics: Optional[AppMetrics] = None,
+    ) -> None:
         self.cookie = cookie
         self.token = token
         self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.headers = dict(headers or {})
+        self.metrics = metrics
+        self._cookies = _parse_cookie(cookie)
+
+    def _url(self, path: str) -> str:
+        return f'{self.base_url}/{path.rstrip("/")}'
+
+    def _data(self, data: Dict[str, str]) -> Dict[str, str]:
+        return {'token': self.token, **data}
+
+
+class WebAppClient(_BaseWebAppClient):
+    """A client of the endpoints which only the web app can call
+
+    Requests are sent through a :class:`requests.Session` so that TCP and TLS
+    connections are kept alive and pooled across calls.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+        )
+        self._session = requests.Session()
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._session.headers.update(self.headers)
+        self._session.cookies.update(self._cookies)
 
     def request(
         self,
@@ -75,19 +166,609 @@ class WebAppClient:
         path: str,
         data: Dict[str, str],
     ) -> requests.Response:
-        url = f'{self.base_url}/{path.rstrip("/")}'
-        data = {'token': self.token, **data}
-        cookies = {
-            k.strip(): v.strip()
-            for k, v in
-            [c.split('=', 1) for c in self.cookie.split(';')]
+        started_at = time.perf_counter()
+        ok = False
+        try:
+            response = self._session.request(
+                method,
+                self._url(path),
+                data=self._data(data),
+                timeout=self.timeout,
+            )
+            ok = response.status_code == 200
+            return response
+        finally:
+            if self.metrics is not None:
+                self.metrics.api_called('web_app', path, started_at, ok)
+
+    def close(self) -> None:
+        self._session.close()
+
+
+class AsyncWebAppClient(_BaseWebAppClient):
+    """An asyncio flavour of :class:`WebAppClient`
+
+    The underlying :class:`aiohttp.ClientSession` is created on the first
+    request since it has to be bound to a running event loop. A session made
+    by :func:`_shared_web_app_session` can be given instead to share the
+    connection pool between accounts.
+    """
+
+    def __init__(
+        self,
+        *args,
+        session: Optional[aiohttp.ClientSession] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self._session = session
+        self._shared = session is not None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers=self.headers,
+                cookies=self._cookies,
+            )
+        return self._session
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        data: Dict[str, str],
+    ) -> WebAppResponse:
+        session = self._get_session()
+        started_at = time.perf_counter()
+        ok = False
+        try:
+            async with session.request(
+                method,
+                self._url(path),
+                data=self._data(data),
+                # a shared session knows nothing about the account
+                cookies=self._cookies if self._shared else None,
+                headers=self.headers if self._shared else None,
+            ) as response:
+                ok = response.status == 200
+                return WebAppResponse(
+                    status_code=response.status,
+                    content=await response.read(),
+                    headers=requests.structures.CaseInsensitiveDict(
+                        response.headers,
+                    ),
+                )
+        finally:
+            if self.metrics is not None:
+                self.metrics.api_called('web_app', path, started_at, ok)
+
+    async def close(self) -> None:
+        if self._session is not None and not self._shared:
+            await self._session.close()
+
+
+async def _shared_web_app_session(
+    pool_size: int,
+    timeout: float,
+) -> aiohttp.ClientSession:
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=pool_size),
+        timeout=aiohttp.ClientTimeout(total=timeout),
+        # never send a cookie set for an account with another one
+        cookie_jar=aiohttp.DummyCookieJar(),
+    )
+
+
+class _StubClient:
+    """Count calls instead of sending them, e.g. while replaying a journal"""
+
+    def __init__(self) -> None:
+        self.calls: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def _call(self, method: str, params: Dict[str, Any]) -> None:
+        # marks are sent from a timer thread
+        with self._lock:
+            self.calls[method] += 1
+        logger.debug('stubbed: method=%s, params=%s', method, params)
+
+
+class StubWebClient(_StubClient):
+    """A stand-in for the part of :class:`slack.WebClient` the app uses"""
+
+    def api_call(self, api_method: str, **kwargs) -> Dict[str, Any]:
+        self._call(api_method, kwargs)
+        if api_method == 'users.prefs.get':
+            # only called when the prefs are unknown at an open record, and
+            # the prefs journaled right after it replace these
+            return {'ok': True, 'prefs': {'muted_channels': ''}}
+        return {'ok': True}
+
+    def chat_postMessage(self, **kwargs) -> Dict[str, Any]:
+        return self.api_call('chat.postMessage', json=kwargs)
+
+    def reactions_add(self, **kwargs) -> Dict[str, Any]:
+        return self.api_call('reactions.add', json=kwargs)
+
+    def usergroups_users_list(self, **kwargs) -> Dict[str, Any]:
+        self._call('usergroups.users.list', kwargs)
+        # members are only known from the journaled subteam events
+        return {'ok': False, 'error': 'stubbed'}
+
+
+class StubWebAppClient(_StubClient):
+    """A stand-in for :class:`WebAppClient`"""
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        data: Dict[str, str],
+    ) -> WebAppResponse:
+        self._call(path, data)
+        return WebAppResponse(status_code=200, content=b'{"ok":true}')
+
+    def close(self) -> None:
+        pass
+
+
+def parse_ts(ts: str) -> int:
+    """Convert a Slack timestamp into microseconds without losing precision"""
+    seconds, _, fraction = ts.partition('.')
+    return int(seconds) * 1000000 + int(fraction[:6].ljust(6, '0'))
+
+
+def format_ts(value: int) -> str:
+    """Convert microseconds back into a Slack timestamp"""
+    return f'{value // 1000000}.{value % 1000000:06d}'
+
+
+def _log_marked(
+    channel: str,
+    thread_ts: Optional[str],
+    ts: str,
+    response,
+) -> None:
+    if (
+        (response.status_code != 200) or
+        # only subscriptions.thread.mark tells the result in its body
+        (thread_ts is not None and not response.json()['ok'])
+    ):
+        logger.error(
+            'Failed to call the API: status_code=%s, content=%s',
+            response.status_code,
+            response.content,
+        )
+    elif thread_ts is None:
+        logger.info(
+            'a message has been suppressed: channel=%s, ts=%s',
+            channel,
+            ts,
+        )
+    else:
+        logger.info(
+            'the message in a thread has been suppressed: channel=%s, ts=%s',
+            channel,
+            ts,
+        )
+
+
+def _api_method_of(path: str) -> str:
+    """e.g. ``conversations.mark`` of ``/api/conversations.mark``"""
+    return path.rstrip('/').rsplit('/', 1)[-1]
+
+
+class _BaseMarkCoalescer:
+    """Things shared between the mark coalescers
+
+    Marking a message as read makes every mark of older messages in the same
+    channel, or the same thread, obsolete. So only the newest ``ts`` is kept
+    per ``(channel, thread_ts)`` and pending marks are sent once ``window``
+    seconds have passed or ``max_batch`` channels and threads are pending.
+    """
+
+    def __init__(
+        self,
+        client: Union[WebAppClient, AsyncWebAppClient],
+        window: float = 1.0,
+        max_batch: int = 50,
+        scheduler: Optional[Union[ApiScheduler, AsyncApiScheduler]] = None,
+    ) -> None:
+        self.client = client
+        self.window = window
+        self.max_batch = max_batch
+        self.scheduler = scheduler
+        #: the number of marks which have been made obsolete before sent
+        self.coalesced = 0
+        self._marks: Dict[Tuple[str, Optional[str]], str] = {}
+
+    def mark(self, channel: str, ts: str) -> None:
+        self._schedule(channel, None, ts)
+
+    def mark_thread(self, channel: str, thread_ts: str, ts: str) -> None:
+        self._schedule(channel, thread_ts, ts)
+
+    def _schedule(self, channel: str, thread_ts: Optional[str], ts: str):
+        raise NotImplementedError
+
+    def _add(self, channel: str, thread_ts: Optional[str], ts: str) -> bool:
+        """Add a mark and tell if the pending marks should be sent now"""
+        key = (channel, thread_ts)
+        current = self._marks.get(key)
+        if current is not None:
+            self.coalesced += 1
+            if parse_ts(current) >= parse_ts(ts):
+                return False
+        self._marks[key] = ts
+        return self.window <= 0 or len(self._marks) >= self.max_batch
+
+    def _take(self) -> Dict[Tuple[str, Optional[str]], str]:
+        marks, self._marks = self._marks, {}
+        return marks
+
+    @staticmethod
+    def _request_of(
+        channel: str,
+        thread_ts: Optional[str],
+        ts: str,
+    ) -> Tuple[str, Dict[str, str]]:
+        if thread_ts is None:
+            return '/api/conversations.mark', {'channel': channel, 'ts': ts}
+        else:
+            return '/api/subscriptions.thread.mark', {
+                'channel': channel,
+                'thread_ts': thread_ts,
+                'ts': ts,
+                'read': '1',
+            }
+
+    def _submit(self, channel: str, thread_ts: Optional[str], ts: str):
+        """Hand a mark to the scheduler without waiting for it"""
+        path, data = self._request_of(channel, thread_ts, ts)
+        self.scheduler.submit(
+            _api_method_of(path),
+            self.client.request,
+            'POST',
+            path,
+            data,
+            key=(channel, thread_ts),
+        ).add_done_callback(partial(self._sent, channel, thread_ts, ts))
+
+    @staticmethod
+    def _sent(
+        channel: str,
+        thread_ts: Optional[str],
+        ts: str,
+        future: Union[
+            'concurrent.futures.Future[Any]',
+            'asyncio.Future[Any]',
+        ],
+    ) -> None:
+        """Log a mark handed to a scheduler once it has been sent"""
+        if future.cancelled():
+            # superseded by a newer mark while waiting for its turn
+            return
+        e = future.exception()
+        if e is not None:
+            logger.error(
+                'failed to mark: channel=%s',
+                channel,
+                exc_info=(type(e), e, e.__traceback__),
+            )
+        else:
+            _log_marked(channel, thread_ts, ts, future.result())
+
+
+class MarkCoalescer(_BaseMarkCoalescer):
+    """Coalesce marks in front of :class:`WebAppClient`
+
+    Pending marks are sent from a timer thread, or handed to ``scheduler``
+    without waiting for them to be sent.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+
+    def _schedule(self, channel: str, thread_ts: Optional[str], ts: str):
+        with self._lock:
+            flush_now = self._add(channel, thread_ts, ts)
+            if not flush_now and self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if flush_now:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            marks = self._take()
+
+        for (channel, thread_ts), ts in marks.items():
+            if self.scheduler is not None:
+                self._submit(channel, thread_ts, ts)
+                continue
+            path, data = self._request_of(channel, thread_ts, ts)
+            try:
+                response = self.client.request('POST', path, data)
+            except Exception:
+                logger.exception('failed to mark: channel=%s', channel)
+            else:
+                _log_marked(channel, thread_ts, ts, response)
+
+
+class AsyncMarkCoalescer(_BaseMarkCoalescer):
+    """Coalesce marks in front of :class:`AsyncWebAppClient`
+
+    Requests are handed to ``spawn``, e.g. :meth:`AsyncPipeline.spawn`, so
+    that they share the concurrency limit with the other side effects. With
+    ``scheduler``, they are handed to it instead so that they never hold a
+    slot of the pipeline while waiting for their turn.
+    """
+
+    def __init__(
+        self,
+        client: AsyncWebAppClient,
+        spawn: Callable[[Awaitable[None]], None],
+        *args,
+        **kwargs,
+    ) -> None:
+        super().__init__(client, *args, **kwargs)
+        self._spawn = spawn
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def _schedule(self, channel: str, thread_ts: Optional[str], ts: str):
+        if self._add(channel, thread_ts, ts):
+            self.flush()
+        elif self._timer is None:
+            loop = asyncio.get_event_loop()
+            self._timer = loop.call_later(self.window, self.flush)
+
+    def flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        for (channel, thread_ts), ts in self._take().items():
+            if self.scheduler is not None:
+                self._submit(channel, thread_ts, ts)
+            else:
+                self._spawn(self._send(channel, thread_ts, ts))
+
+    async def _send(
+        self,
+        channel: str,
+        thread_ts: Optional[str],
+        ts: str,
+    ) -> None:
+        path, data = self._request_of(channel, thread_ts, ts)
+        response = await self.client.request('POST', path, data)
+        _log_marked(channel, thread_ts, ts, response)
+
+
+class UsergroupCache:
+    """A bounded cache of usergroup members keyed by a usergroup ID
+
+    Entries expire after ``ttl`` seconds and the least recently used one is
+    evicted once more than ``maxsize`` usergroups are cached.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 256,
+        ttl: float = 3600.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries: 'OrderedDict[str, Tuple[float, FrozenSet[str]]]' = (
+            OrderedDict()
+        )
+
+    def get(self, usergroup: str) -> Optional[FrozenSet[str]]:
+        entry = self._entries.get(usergroup)
+        if entry is None:
+            return None
+
+        fetched_at, users = entry
+        if self._clock() - fetched_at > self.ttl:
+            del self._entries[usergroup]
+            return None
+
+        self._entries.move_to_end(usergroup)
+        return users
+
+    def put(self, usergroup: str, users: FrozenSet[str]) -> None:
+        self._entries[usergroup] = (self._clock(), users)
+        self._entries.move_to_end(usergroup)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, usergroup: str) -> None:
+        self._entries.pop(usergroup, None)
+
+    def dump(self) -> Dict[str, Tuple[float, List[str]]]:
+        """Unexpired entries with their ages, least recently used first"""
+        now = self._clock()
+        return {
+            usergroup: (now - fetched_at, sorted(users))
+            for usergroup, (fetched_at, users) in list(self._entries.items())
+            if now - fetched_at <= self.ttl
         }
-        return requests.request(method, url, data=data, cookies=cookies)
+
+    def load(
+        self,
+        entries: Mapping[str, Tuple[float, List[str]]],
+        elapsed: float = 0.0,
+    ) -> None:
+        """Put dumped entries which got ``elapsed`` seconds older"""
+        now = self._clock()
+        for usergroup, (age, users) in entries.items():
+            if age + elapsed <= self.ttl:
+                self._entries[usergroup] = (
+                    now - age - elapsed,
+                    frozenset(users),
+                )
+                self._entries.move_to_end(usergroup)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class ReactionLedger:
+    """Reactions of the user on messages, so as not to add them twice
+
+    It is kept up to date by ``reaction_added`` and ``reaction_removed``
+    events as well as by the reactions the app adds. Only the ``maxsize``
+    most recent reactions are remembered; adding an evicted one again is
+    answered with ``already_reacted`` as before.
+    """
+
+    def __init__(self, maxsize: int = 10000) -> None:
+        self.maxsize = maxsize
+        self._reactions: 'OrderedDict[Tuple[str, str, str], None]' = (
+            OrderedDict()
+        )
+
+    def has(self, channel: str, ts: str, reaction: str) -> bool:
+        return (channel, ts, reaction) in self._reactions
+
+    def add(self, channel: str, ts: str, reaction: str) -> None:
+        key = (channel, ts, reaction)
+        self._reactions[key] = None
+        self._reactions.move_to_end(key)
+        while len(self._reactions) > self.maxsize:
+            self._reactions.popitem(last=False)
+
+    def discard(self, channel: str, ts: str, reaction: str) -> None:
+        self._reactions.pop((channel, ts, reaction), None)
+
+    def __len__(self) -> int:
+        return len(self._reactions)
+
+
+class MuteDecisions:
+    """Whether the messages of a channel are suppressed, memoized per channel
+
+    A decision depends only on the options and the muted channels, so it
+    is made once per channel. The decisions are dropped when the muted
+    channels change, i.e. the prefs are fetched again or a ``pref_change``
+    event comes, or once more than ``maxsize`` channels are decided.
+    """
+
+    def __init__(
+        self,
+        include_muted_channels: bool,
+        include_dm: bool,
+        include: Optional[List[str]],
+        exclude: Optional[List[str]],
+        maxsize: int = 10000,
+    ) -> None:
+        self.include_muted_channels = include_muted_channels
+        self.include_dm = include_dm
+        # an empty list given by the option is as good as none
+        self.include = frozenset(include) if include else None
+        self.exclude = frozenset(exclude) if exclude else None
+        self.maxsize = maxsize
+        self._muted_channels: Optional[FrozenSet[str]] = None
+        self._decisions: Dict[str, bool] = {}
+
+    def should_be_muted(
+        self,
+        message: 'Message',
+        muted_channels: FrozenSet[str],
+    ) -> bool:
+        # the muted channels are parsed into a new set whenever they change
+        if (
+            muted_channels is not self._muted_channels or
+            len(self._decisions) >= self.maxsize
+        ):
+            self._muted_channels = muted_channels
+            self._decisions = {}
+
+        decision = self._decisions.get(message.channel)
+        if decision is None:
+            decision = self._decisions[message.channel] = self._decide(
+                message,
+                muted_channels,
+            )
+        return decision
+
+    def _decide(
+        self,
+        message: 'Message',
+        muted_channels: FrozenSet[str],
+    ) -> bool:
+        if not self.include_dm and message.is_dm:
+            return False
+
+        channel = message.channel
+
+        return (
+            self.include_muted_channels and
+            channel in muted_channels
+        ) or (
+            self.include is not None and
+            channel in self.include
+        ) or (
+            self.exclude is not None and
+            channel not in self.exclude
+        )
+
+
+#: keywords which remind me of the time card
+TIME_CARD_KEYWORDS = ['おわり', '終わり', '開始', 'かいし']
+
+
+class MessageRules:
+    """``APP_ON_MESSAGE_CONF`` and the time card keywords compiled together
+
+    The rules are evaluated in a single pass over a text by
+    :class:`matcher.RuleMatcher`. The result for the latest text is kept,
+    so subscribers looking at the same message share one evaluation.
+    """
+
+    def __init__(self, conf: List[Dict[str, Any]]) -> None:
+        self.conf = conf
+        time_card = [
+            {'method': '__contains__', 'arguments': [keyword]}
+            for keyword in TIME_CARD_KEYWORDS
+        ]
+        self._matcher = RuleMatcher(conf + time_card)
+        self._time_card = frozenset(
+            range(len(conf), len(conf) + len(time_card)),
+        )
+        self._last: Tuple[Optional[str], FrozenSet[int]] = (None, frozenset())
+
+    def match(self, text: str) -> FrozenSet[int]:
+        last_text, matched = self._last
+        if text is not last_text:
+            matched = self._matcher.match(text)
+            self._last = (text, matched)
+        return matched
+
+    def matched_conf(self, text: str) -> List[Dict[str, Any]]:
+        matched = self.match(text)
+        return [c for i, c in enumerate(self.conf) if i in matched]
+
+    def is_time_card(self, text: str) -> bool:
+        return not self._time_card.isdisjoint(self.match(text))
 
 
 def guard(
     pred: Callable[['State'], bool],
 ) -> Callable[[Callable], Callable]:
+    # for a coroutine function, the wrapper returns either a coroutine or
+    # None; a filtered out event does not even create a coroutine
     def deco(f: Callable[..., None]):
         @wraps(f)
         def wrapper(state: 'State', *args, **kwargs) -> None:
@@ -109,82 +790,158 @@ ACTION_TYPES = enum.Enum('ACTION_TYPES', [
     'OPEN',
     'MESSAGE',
     'GET_PREFS',
+    'PREF_CHANGE',
+    'REACTION_ADDED',
     'REACTION_REMOVED',
+    'SUBTEAM_MEMBERS_CHANGED',
+    'SUBTEAM_UPDATED',
+    'THREAD_SUBSCRIPTION',
 ])
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True)
 class Action:
     type_: ACTION_TYPES
     payload: Dict[str, Any]
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True)
+class Batch:
+    """Actions reduced one by one and notified to subscribers at once"""
+    actions: Tuple[Any, ...]
+
+
+@dataclasses.dataclass(frozen=True)
 class Channel:
+    __slots__ = ['channel', 'last_ts']
+
     channel: str
+    #: the timestamp of the latest message in microseconds
     last_ts: int
 
 
-@dataclasses.dataclass
-class Message:
+@dataclasses.dataclass(frozen=True)
+class Thread:
+    __slots__ = ['channel', 'thread_ts', 'read_ts', 'followed']
+
     channel: str
-    user: str
-    ts: str
-    thread_ts: Optional[str]
-    text: str
-    is_bot: bool
-    _payload: Dict[str, Any]
+    thread_ts: str
+    #: the timestamp in microseconds up to which the thread has been read
+    #: or is about to be marked as read
+    read_ts: int
+    #: if the user follows the thread; None until an event tells
+    followed: Optional[bool]
+
+
+def _is_dm_channel(channel: str) -> bool:
+    # as --include-dm has always told them
+    return channel[0] in ('G', 'U')
+
+
+class _EventView:
+    """A read-only view of the data of an RTM event
+
+    A view refers to the data rather than copying it, and decodes a field
+    only when it is read. ``_fields`` are the fields a state log shows.
+    """
+    __slots__ = ['_data']
+    _fields: Tuple[str, ...] = ()
+    #: the fields a state change log shows, i.e. ids but no contents
+    _logged_fields: Tuple[str, ...] = ()
+
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self._data = data
+
+    def __repr__(self) -> str:
+        fields = ', '.join(f'{f}={getattr(self, f)!r}' for f in self._fields)
+        return f'{type(self).__name__}({fields})'
+
+
+class Message(_EventView):
+    """A message event
+
+    Only ``channel`` and ``ts``, which every message is tracked by, are read
+    up front; ``user`` and ``text`` are decoded by the subscribers reading
+    them, i.e. not for a message filtered out by the cheaper checks such as
+    ``is_bot``, ``is_dm`` and ``is_thread``.
+    """
+    __slots__ = ['channel', 'ts', '_user', '_text']
+    _fields = ('channel', 'user', 'ts', 'thread_ts', 'text', 'is_bot')
+    # neither decoded nor written to the logs for every message
+    _logged_fields = ('channel', 'ts', 'thread_ts', 'is_bot')
+
+    def __init__(self, data: Dict[str, Any]) -> None:
+        super().__init__(data)
+        # a few channels appear in a huge number of messages
+        self.channel: str = sys.intern(data['channel'])
+        self.ts: str = data['ts']
+        self._user: Optional[str] = None
+        self._text: Optional[str] = None
 
     @classmethod
-    def from_payload(self, payload):
+    def from_payload(cls, payload: Dict[str, Any]) -> Optional['Message']:
         data = payload.get('data')
-        if all([
-            data,
-            'channel' in data,
-            'ts' in data,
-        ]):
+        if data and 'channel' in data and 'ts' in data:
+            return cls(data)
+        else:
+            return None
+
+    @property
+    def is_bot(self) -> bool:
+        return 'bot_id' in self._data
+
+    @property
+    def is_dm(self) -> bool:
+        return _is_dm_channel(self.channel)
+
+    @property
+    def is_thread(self) -> bool:
+        return self._data.get('thread_ts') is not None
+
+    @property
+    def thread_ts(self) -> Optional[str]:
+        return self._data.get('thread_ts')
+
+    @property
+    def user(self) -> str:
+        if self._user is None:
+            data = self._data
             if 'bot_id' in data:
                 # first of all, check if the data is sent by bot
                 # Bot user also has its user id
-                user = data['bot_id']
-                is_bot = True
+                self._user = data['bot_id']
             elif 'user' in data:
-                user = data['user']
-                is_bot = False
+                self._user = data['user']
             else:
-                user = data.get('message', {}).get('user', 'UNKNOWN')
-                is_bot = False
+                self._user = data.get('message', {}).get('user', 'UNKNOWN')
+        return self._user
 
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            data = self._data
             if 'text' in data:
-                text = data['text']
+                self._text = data['text']
             else:
-                text = data.get('message', {}).get('text', '')
-
-            payload = UncopiableProxy(dict(payload))
-            return Message(
-                channel=data['channel'],
-                user=user,
-                ts=data['ts'],
-                thread_ts=data.get('thread_ts'),
-                text=text,
-                is_bot=is_bot,
-                _payload=payload,
-            )
-        else:
-            return None
+                self._text = data.get('message', {}).get('text', '')
+        return self._text
 
 
 REACTION_STATE = enum.Enum('REACTION_STATE', ['ADDED', 'REMOVED'])
 
 
-@dataclasses.dataclass
-class Reaction:
-    channel: str
-    user: str
-    ts: int
-    reaction: str
-    state: REACTION_STATE
-    _payload: Dict[str, Any]
+class Reaction(_EventView):
+    __slots__ = ['state']
+    _fields = ('channel', 'user', 'ts', 'reaction', 'state')
+    _logged_fields = _fields
+
+    def __init__(self, data: Dict[str, Any], state: REACTION_STATE) -> None:
+        super().__init__(data)
+        self.state = state
+
+    @classmethod
+    def from_addition_payload(cls, payload):
+        return cls.from_payload(payload, REACTION_STATE.ADDED)
 
     @classmethod
     def from_removal_payload(cls, payload):
@@ -199,95 +956,949 @@ class Reaction:
         # https://api.slack.com/events/reaction_added
         data = payload['data']
         if data['item']['type'] == 'message':
-            return cls(
-                channel=data['item']['channel'],
-                user=data['user'],
-                ts=data['item']['ts'],
-                reaction=data['reaction'],
-                state=state,
-                _payload=data,
-            )
+            return cls(data, state)
         else:
             return None
 
+    @property
+    def channel(self) -> str:
+        return self._data['item']['channel']
 
-@dataclasses.dataclass
-class PrefsResponse:
-    response: SlackResponse
-    updated_at: datetime.datetime
+    @property
+    def ts(self) -> str:
+        return self._data['item']['ts']
 
     @property
-    def muted_channels(self) -> List[str]:
-        return self.response['prefs']['muted_channels'].split(',')
+    def user(self) -> str:
+        return self._data['user']
 
     @property
-    def is_outdated(self):
-        interval = datetime.timedelta(
-            seconds=int(os.environ['APP_GET_PREFS_INT']),
-        )
-        now = datetime.datetime.now()
-        return (now - self.updated_at) > interval
+    def reaction(self) -> str:
+        return self._data['reaction']
 
 
-@dataclasses.dataclass
-class State:
-    web_client: Optional[UncopiableProxy[slack.WebClient]] = None
-    self_id: Optional[str] = None
-    #: the latest message was sent
-    latest: Optional[Union[Message, Reaction]] = None
-    channels: Dict[str, Channel] = dataclasses.field(default_factory=dict)
-    prefs: Optional[PrefsResponse] = None
+@dataclasses.dataclass(frozen=True)
+class UsergroupChange:
+    usergroup: str
+    #: all the members if the event tells them, otherwise None
+    users: Optional[FrozenSet[str]]
 
-    @property
-    def is_ready(self):
-        return (
-            self.web_client is not None and
-            self.prefs is not None
+    @classmethod
+    def from_members_changed_payload(
+        cls,
+        payload: Dict[str, Any],
+    ) -> 'UsergroupChange':
+        # https://api.slack.com/events/subteam_members_changed
+        # only the difference is sent; let it be fetched again
+        return cls(usergroup=payload['data']['subteam_id'], users=None)
+
+    @classmethod
+    def from_updated_payload(
+        cls,
+        payload: Dict[str, Any],
+    ) -> 'UsergroupChange':
+        # https://api.slack.com/events/subteam_updated
+        subteam = payload['data']['subteam']
+        users = subteam.get('users')
+        return cls(
+            usergroup=subteam['id'],
+            users=frozenset(users) if users is not None else None,
         )
 
 
-# Redux state like object
-# =======================
+@dataclasses.dataclass(frozen=True)
+class PrefsResponse:
+    response: slack.web.slack_response.SlackResponse
+    updated_at: datetime.datetime
+    #: parsed once since it is looked up for every message
+    muted_channels: FrozenSet[str]
 
-class Store:
-    def __init__(self, reducer, initial_state=None):
-        self.reducer = reducer
-        self._state = initial_state or State()
-        self.subscribers = []
+    @staticmethod
+    def parse_channels(value: str) -> FrozenSet[str]:
+        return frozenset(c for c in value.split(',') if c)
 
-    def dispatch(self, action):
-        if callable(action):
-            action(self.dispatch, self.get_state)
+    @classmethod
+    def from_response(
+        cls,
+        response: slack.web.slack_response.SlackResponse,
+    ) -> PrefsResponse:
+        return cls(
+            response=response,
+            updated_at=datetime.datetime.now(),
+            muted_channels=cls.parse_channels(
+                response['prefs']['muted_channels'],
+            ),
+        )
+
+    def changed(self, name: str, value: Any) -> 'PrefsResponse':
+        """Apply a ``pref_change`` event"""
+        if name == 'muted_channels':
+            return dataclasses.replace(
+                self,
+                updated_at=datetime.datetime.now(),
+                muted_channels=self.parse_channels(value),
+            )
         else:
-            self.state = self.reducer(copy.deepcopy(self.state), action)
+            # the other prefs are not used
+            return self
 
-    def get_state(self):
-        return self._state
+    def age(self) -> float:
+        """Seconds since the prefs were updated"""
+        return (datetime.datetime.now() - self.updated_at).total_seconds()
 
-    def set_state(self, new_state, silence=False):
-        old_state = self._state
-        self._state = new_state
-        if old_state != new_state and not silence:
-            self._notify()
 
-    state = property(get_state, set_state)
+#: the environment variables an account cannot do without
+REQUIRED_ENV = (
+    'SLACK_USER_ACCESS_TOKEN',
+    'SLACK_WEB_APP_COOKIE',
+    'SLACK_WEB_APP_TOKEN',
+    'SLACK_WEB_APP_BASE_URL',
+    'APP_GET_PREFS_INT',
+    'APP_UNREAD_REACTION',
+    'APP_READ_REACTION',
+    'APP_TIME_CARD',
+    'APP_DM_TO_SELF',
+)
 
-    def _notify(self):
-        for subscriber in self.subscribers:
-            if subscriber is not None:
-                try:
-                    subscriber()
-                except Exception:
-                    logger.exception('a subscriber raised an exception')
 
-    def subscribe(self, subscriber):
-        self.subscribers += [subscriber]
-        idx = len(self.subscribers) - 1
+class ConfigError(ValueError):
+    pass
 
-        def _unsubscribe():
-            self.subscribers[idx] = None
 
-        return _unsubscribe
+def read_dotenv(path: str) -> Dict[str, str]:
+    """Read ``KEY=value`` lines of a ``.env`` file; ``#`` starts a comment"""
+    env = {}
+    with open(path) as f:
+        for line in f.read().split('\n'):
+            if line and not line.startswith('#'):
+                k, v = line.split('=', 1)
+                env[k.rstrip()] = v.lstrip()
+    return env
+
+
+def load_env(
+    path: str = '.env',
+    environ: Optional[Mapping[str, str]] = None,
+) -> Mapping[str, str]:
+    """The environment overridden by ``path`` if it exists, read once
+
+    Nothing but :class:`Account` reads it, so no event handler ever touches
+    :data:`os.environ`.
+    """
+    env = dict(os.environ if environ is None else environ)
+    if os.path.isfile(path):
+        env.update(read_dotenv(path))
+    return immutables.Map(env)
+
+
+@dataclasses.dataclass(frozen=True)
+class Account:
+    """Settings of a user whose messages are suppressed
+
+    Built and validated once at startup by :meth:`from_env`, and passed
+    around in :attr:`State.account`.
+    """
+    name: str
+    token: str
+    web_app_cookie: str
+    web_app_token: str
+    web_app_base_url: str
+    get_prefs_interval: float
+    on_message_conf: List[Dict[str, Any]]
+    unread_reaction: str
+    read_reaction: str
+    time_card: str
+    dm_to_self: str
+
+    @classmethod
+    def from_env(
+        cls,
+        env: Mapping[str, str],
+        name: str = 'default',
+    ) -> 'Account':
+        missing = [k for k in REQUIRED_ENV if k not in env]
+        if missing:
+            raise ConfigError(f'{name}: {", ".join(missing)} not set')
+
+        try:
+            get_prefs_interval = float(env['APP_GET_PREFS_INT'])
+        except ValueError:
+            get_prefs_interval = 0.0
+        # the prefs would be refreshed on every turn of the event loop
+        if not get_prefs_interval > 0:
+            raise ConfigError(
+                f'{name}: APP_GET_PREFS_INT is not a positive number: '
+                f'{env["APP_GET_PREFS_INT"]!r}',
+            )
+
+        try:
+            on_message_conf = json.loads(env.get('APP_ON_MESSAGE_CONF', '[]'))
+        except ValueError as e:
+            raise ConfigError(
+                f'{name}: APP_ON_MESSAGE_CONF is not JSON: {e}',
+            ) from e
+        if not (
+            isinstance(on_message_conf, list) and
+            all(isinstance(c, dict) for c in on_message_conf)
+        ):
+            raise ConfigError(
+                f'{name}: APP_ON_MESSAGE_CONF is not a list of objects',
+            )
+
+        return cls(
+            name=name,
+            token=env['SLACK_USER_ACCESS_TOKEN'],
+            web_app_cookie=env['SLACK_WEB_APP_COOKIE'],
+            web_app_token=env['SLACK_WEB_APP_TOKEN'],
+            web_app_base_url=env['SLACK_WEB_APP_BASE_URL'],
+            get_prefs_interval=get_prefs_interval,
+            on_message_conf=on_message_conf,
+            unread_reaction=env['APP_UNREAD_REACTION'],
+            read_reaction=env['APP_READ_REACTION'],
+            time_card=env['APP_TIME_CARD'],
+            dm_to_self=env['APP_DM_TO_SELF'],
+        )
+
+    @classmethod
+    def load_all(cls, path: str, env: Mapping[str, str]) -> List['Account']:
+        """Load accounts from a JSON list of objects like the environment
+
+        e.g. ``[{"name": "alice", "SLACK_USER_ACCESS_TOKEN": "...", ...}]``;
+        a missing variable is taken from ``env``, so that the settings
+        shared by every account can be given once.
+        """
+        with open(path) as f:
+            return cls.from_confs(json.load(f), env)
+
+    @classmethod
+    def from_confs(
+        cls,
+        confs: Iterable[Mapping[str, str]],
+        env: Mapping[str, str],
+    ) -> List['Account']:
+        accounts = [
+            cls.from_env({**env, **conf}, name=conf['name'])
+            for conf in confs
+        ]
+        names = [a.name for a in accounts]
+        if len(set(names)) != len(names):
+            raise ValueError(f'account names are not unique: {names}')
+        return accounts
+
+
+@dataclasses.dataclass(frozen=True)
+class State:
+    """An immutable snapshot of the app state
+
+    Reducers never modify a state in place. They build a new one with
+    :func:`dataclasses.replace` and share every untouched field with the
+    previous snapshot; ``channels`` is a persistent map so that adding a
+    channel costs O(log n) instead of copying the whole mapping.
+    """
+    web_client: Optional[slack.WebClient] = None
+    self_id: Optional[str] = None
+    #: the latest message was sent
+    latest: Optional[Union[Message, Reaction, UsergroupChange]] = None
+    channels: 'immutables.Map[str, Channel]' = dataclasses.field(
+        default_factory=immutables.Map,
+    )
+    #: by ``(channel, thread_ts)``
+    threads: 'immutables.Map[Tuple[str, str], Thread]' = dataclasses.field(
+        default_factory=immutables.Map,
+    )
+    prefs: Optional[PrefsResponse] = None
+    #: never changes; set to the initial state of a store
+    account: Optional[Account] = None
+
+    @property
+    def is_ready(self):
+        return (
+            self.web_client is not None and
+            self.prefs is not None
+        )
+
+
+# Redux state like object
+# =======================
+
+class _Subscription:
+    __slots__ = ['subscriber', 'name', 'action_types', 'selector', 'selected']
+
+    def __init__(
+        self,
+        subscriber: Callable[[], None],
+        name: str,
+        action_types: Optional[FrozenSet[ACTION_TYPES]],
+        selector: Optional[Callable[[State], Any]],
+        state: State,
+    ) -> None:
+        self.subscriber = subscriber
+        self.name = name
+        self.action_types = action_types
+        self.selector = selector
+        self.selected = selector(state) if selector is not None else None
+
+    def routes(self, action_type: Optional[ACTION_TYPES]) -> bool:
+        return (
+            self.action_types is None or
+            action_type is None or
+            action_type in self.action_types
+        )
+
+
+#: ``middleware(store, next_dispatch)`` returns a dispatch function which
+#: passes an action on to ``next_dispatch``, or not
+Middleware = Callable[[Any, Callable[[Any], Any]], Callable[[Any], Any]]
+
+
+def thunk_middleware(store, next_dispatch):
+    """Call a function instead of reducing it"""
+    def _(action):
+        if callable(action):
+            # a coroutine is returned if the thunk is an async one
+            return action(store.dispatch, store.get_state)
+        return next_dispatch(action)
+
+    return _
+
+
+def logging_middleware(store, next_dispatch):
+    def _(action):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('dispatching an action: type=%s', action.type_.name)
+        return next_dispatch(action)
+
+    return _
+
+
+def _event_key(action: Action) -> Optional[Tuple[Any, ...]]:
+    payload = action.payload
+    data = payload.get('data') if isinstance(payload, dict) else None
+    if not isinstance(data, dict):
+        return None
+    ts = data.get('event_ts') or data.get('ts')
+    if ts is None:
+        return None
+    return (action.type_, data.get('channel'), ts)
+
+
+def dedupe_middleware(maxsize: int) -> Middleware:
+    """Drop an event delivered again, e.g. around a reconnection
+
+    An event is identified by its action type, channel and timestamp, and
+    the last ``maxsize`` of them are remembered.
+    """
+    def middleware(store, next_dispatch):
+        seen: 'OrderedDict[Tuple[Any, ...], None]' = OrderedDict()
+
+        def _(action):
+            key = _event_key(action)
+            if key is not None:
+                if key in seen:
+                    logger.debug('a duplicate event is dropped: key=%s', key)
+                    return None
+                seen[key] = None
+                if len(seen) > maxsize:
+                    seen.popitem(last=False)
+            return next_dispatch(action)
+
+        return _
+
+    return middleware
+
+
+def timing_middleware(metrics: AppMetrics) -> Middleware:
+    """Observe seconds spent in reducing an action and notifying it
+
+    Subscribers of a batch are notified after its last action, so that
+    time is not included.
+    """
+    def middleware(store, next_dispatch):
+        def _(action):
+            started_at = time.perf_counter()
+            try:
+                return next_dispatch(action)
+            finally:
+                metrics.dispatch_seconds.observe(
+                    time.perf_counter() - started_at,
+                    action.type_.name,
+                )
+
+        return _
+
+    return middleware
+
+
+class Store:
+    """A Redux store like object
+
+    A subscriber can be limited to some action types, and to changes of a
+    slice of the state picked by a selector. Since untouched parts of a
+    state are shared, a slice has changed if and only if the selector
+    returns another object.
+
+    An action goes through ``middlewares`` in the given order before it is
+    reduced. A :class:`Batch` of actions, e.g. ``OPEN`` and ``GET_PREFS``
+    on a connection, notifies subscribers once for all of them.
+    """
+
+    def __init__(
+        self,
+        reducer,
+        initial_state=None,
+        metrics: Optional[AppMetrics] = None,
+        middlewares: Iterable['Middleware'] = (thunk_middleware,),
+    ):
+        self.reducer = reducer
+        self._state = initial_state or State()
+        self.metrics = metrics
+        self._action_type: Optional[ACTION_TYPES] = None
+        #: action types which changed the state in the current batch
+        self._batched: Optional[Set[Optional[ACTION_TYPES]]] = None
+        self._subscriptions: Dict[int, _Subscription] = {}
+        self._next_id = 0
+        #: subscriptions to notify, by action type, in the subscribed order
+        self._routes: Dict[Optional[ACTION_TYPES], List[_Subscription]] = {}
+
+        dispatch = self._reduce
+        for middleware in reversed(list(middlewares)):
+            dispatch = middleware(self, dispatch)
+        self._dispatch = dispatch
+
+    def dispatch(self, action):
+        if isinstance(action, Batch):
+            return self.batch(action.actions)
+        return self._dispatch(action)
+
+    def batch(self, actions: Iterable[Any]) -> List[Any]:
+        """Dispatch actions and notify subscribers once at the end
+
+        Subscribers see only the last state, so ``state.latest`` of the
+        earlier actions is never reacted to. A batch within a batch joins
+        the outer one, while an async thunk runs after the batch.
+        """
+        outer = self._batched is None
+        if outer:
+            self._batched = set()
+        try:
+            return [self.dispatch(action) for action in actions]
+        finally:
+            if outer:
+                action_types, self._batched = self._batched, None
+                if action_types:
+                    self._notify(action_types)
+
+    def _reduce(self, action):
+        # a state is immutable, so the reducer can be given the current
+        # one as is; it returns the very same object if nothing changed
+        self._action_type = action.type_
+        try:
+            self.state = self.reducer(self.state, action)
+        finally:
+            self._action_type = None
+
+    def get_state(self):
+        return self._state
+
+    def set_state(self, new_state, silence=False):
+        old_state = self._state
+        self._state = new_state
+        if old_state is not new_state and not silence:
+            if self._batched is not None:
+                self._batched.add(self._action_type)
+            else:
+                self._notify((self._action_type,))
+
+    state = property(get_state, set_state)
+
+    def _notify(self, action_types: Collection[Optional[ACTION_TYPES]]):
+        # a state set directly rather than by an action notifies everyone
+        if len(action_types) == 1:
+            (action_type,) = action_types
+            subscriptions = self._routes.get(action_type, ())
+        else:
+            subscriptions = [
+                s for s in self._routes.get(None, ())
+                if any(s.routes(t) for t in action_types)
+            ]
+        for subscription in subscriptions:
+            if subscription.selector is not None:
+                selected = subscription.selector(self._state)
+                if selected is subscription.selected:
+                    continue
+                subscription.selected = selected
+
+            started_at = time.perf_counter()
+            try:
+                subscription.subscriber()
+            except Exception:
+                logger.exception('a subscriber raised an exception')
+                if self.metrics is not None:
+                    self.metrics.subscriber_errors.inc(subscription.name)
+            if self.metrics is not None:
+                self.metrics.subscriber_seconds.observe(
+                    time.perf_counter() - started_at,
+                    subscription.name,
+                )
+
+    def _build_routes(self):
+        subscriptions = list(self._subscriptions.values())
+        self._routes = {
+            action_type: [s for s in subscriptions if s.routes(action_type)]
+            for action_type in [None, *ACTION_TYPES]
+        }
+
+    def subscribe(
+        self,
+        subscriber: Callable[[], None],
+        action_types: Optional[Iterable[ACTION_TYPES]] = None,
+        selector: Optional[Callable[[State], Any]] = None,
+        name: Optional[str] = None,
+    ):
+        """Call ``subscriber`` when the state changes
+
+        Args:
+            subscriber: a function called without arguments
+            action_types: notify only when one of these actions changed
+                the state; every action by default
+            selector: notify only when the returned slice of the state is
+                not the same object as the last time
+            name: a name in metrics; the name of ``subscriber`` by default
+        """
+        if name is None:
+            name = getattr(subscriber, '__name__', type(subscriber).__name__)
+        subscription_id = self._next_id
+        self._next_id += 1
+        self._subscriptions[subscription_id] = _Subscription(
+            subscriber,
+            name,
+            frozenset(action_types) if action_types is not None else None,
+            selector,
+            self._state,
+        )
+        self._build_routes()
+
+        def _unsubscribe():
+            if self._subscriptions.pop(subscription_id, None) is not None:
+                self._build_routes()
+
+        return _unsubscribe
+
+
+class AsyncPipeline:
+    """Feed events to a store in order and run side effects concurrently
+
+    RTM callbacks only enqueue actions, so receiving events never waits for
+    the Slack API. A single consumer dispatches the actions one by one to
+    keep the reduction ordered, while coroutines spawned by subscribers run
+    as tasks, at most ``concurrency`` at a time.
+    """
+
+    def __init__(
+        self,
+        store: Store,
+        concurrency: int,
+        metrics: Optional[AppMetrics] = None,
+    ) -> None:
+        self.store = store
+        self.metrics = metrics
+        self._queue: 'asyncio.Queue[Any]' = asyncio.Queue()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks: Set['asyncio.Task[None]'] = set()
+
+    def put(self, action) -> None:
+        self._queue.put_nowait(action)
+
+    def spawn(
+        self,
+        coro: Optional[Awaitable[None]],
+        name: str = 'effect',
+    ) -> None:
+        if coro is None:
+            # filtered out by guards
+            return
+        task = asyncio.ensure_future(self._run_effect(coro, name))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def spawn_thunk(self, thunk, name: str = 'effect') -> None:
+        """Run an async thunk beside the events instead of in the consumer"""
+        self.spawn(self.store.dispatch(thunk), name)
+
+    async def _run_effect(self, coro: Awaitable[None], name: str) -> None:
+        async with self._semaphore:
+            started_at = time.perf_counter()
+            try:
+                await coro
+            except Exception:
+                logger.exception('a subscriber raised an exception')
+                if self.metrics is not None:
+                    self.metrics.effect_errors.inc(name)
+            if self.metrics is not None:
+                self.metrics.effect_seconds.observe(
+                    time.perf_counter() - started_at,
+                    name,
+                )
+
+    async def run(self) -> None:
+        while True:
+            action = await self._queue.get()
+            try:
+                result = self.store.dispatch(action)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception:
+                logger.exception('an error occured during dispatching')
+            finally:
+                self._queue.task_done()
+
+    async def drain(self) -> None:
+        """Wait until queued actions and running side effects complete"""
+        await self._queue.join()
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
+
+
+class EffectRunner:
+    """Run the side effects of the sync subscribers on a thread of their own
+
+    Subscribers are notified on the thread of the RTM client's event loop,
+    which also receives the events and answers the pings. An API call waits
+    there for its rate limit in :class:`scheduler.ApiScheduler`, so the
+    effects run one by one here instead, in the order they were spawned;
+    the state they see is the one captured when they were spawned. At most
+    ``maxsize`` effects wait, and the ones beyond that are dropped.
+    """
+
+    def __init__(
+        self,
+        store: Store,
+        loop: asyncio.AbstractEventLoop,
+        maxsize: int = 10000,
+        metrics: Optional[AppMetrics] = None,
+    ) -> None:
+        self.store = store
+        self.loop = loop
+        self.metrics = metrics
+        self._queue: 'queue.Queue[Any]' = queue.Queue(maxsize)
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='effects',
+            daemon=True,
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def spawn(self, effect: Callable[[], None], name: str = 'effect'):
+        try:
+            self._queue.put_nowait((effect, name))
+        except queue.Full:
+            logger.warning('too many effects waiting: effect=%s', name)
+            if self.metrics is not None:
+                self.metrics.effect_errors.inc(name)
+
+    def spawn_thunk(self, thunk, name: str = 'effect') -> None:
+        """Run a thunk whose actions are dispatched back on the loop"""
+        self.spawn(partial(thunk, self.dispatch, self.store.get_state), name)
+
+    def dispatch(self, action) -> None:
+        self.loop.call_soon_threadsafe(self.store.dispatch, action)
+
+    def _run(self) -> None:
+        while True:
+            try:
+                # once stopping, the queue is only drained
+                item = self._queue.get(
+                    timeout=0.1 if self._stopping.is_set() else None,
+                )
+            except queue.Empty:
+                return
+            if item is None:
+                return
+            effect, name = item
+            started_at = time.perf_counter()
+            try:
+                effect()
+            except Exception:
+                logger.exception('a subscriber raised an exception')
+                if self.metrics is not None:
+                    self.metrics.effect_errors.inc(name)
+            if self.metrics is not None:
+                self.metrics.effect_seconds.observe(
+                    time.perf_counter() - started_at,
+                    name,
+                )
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Run the effects already spawned, then stop the thread"""
+        if self._thread.is_alive():
+            self._stopping.set()
+            try:
+                # wakes the thread up if it waits for an effect
+                self._queue.put_nowait(None)
+            except queue.Full:
+                # it does not, and stops once the queue is drained
+                pass
+            self._thread.join(timeout)
+
+
+def run_inline(effect: Callable[[], None], name: str = 'effect') -> None:
+    """Run an effect right away, e.g. in a replay where nothing waits"""
+    effect()
+
+
+class PrefsRefresher:
+    """Fetch prefs again in case a ``pref_change`` event has been missed
+
+    Prefs are kept up to date by ``pref_change`` events, so they are fetched
+    only once they have not been updated for ``interval`` seconds. The check
+    runs on the event loop the RTM client runs on, never in the message path.
+    """
+
+    def __init__(
+        self,
+        store: Store,
+        refresh: Callable[[slack.WebClient], None],
+        interval: float,
+        loop: asyncio.AbstractEventLoop,
+    ) -> None:
+        self.store = store
+        #: starts fetching prefs without waiting for them
+        self.refresh = refresh
+        self.interval = interval
+        self.loop = loop
+        self._handle: Optional[asyncio.TimerHandle] = None
+
+    def start(self, delay: Optional[float] = None) -> None:
+        self._handle = self.loop.call_later(
+            self.interval if delay is None else delay,
+            self._tick,
+        )
+
+    def stop(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _tick(self) -> None:
+        delay = self.interval
+        try:
+            state = self.store.state
+            if state.web_client is not None and state.prefs is not None:
+                age = state.prefs.age()
+                if age >= self.interval:
+                    logger.info('prefs are outdated: age=%s', age)
+                    self.refresh(state.web_client)
+                else:
+                    delay = self.interval - age
+        except Exception:
+            logger.exception('failed to refresh prefs')
+        finally:
+            self.start(delay)
+
+
+#: messages per page of ``conversations.history``
+BACKFILL_PAGE_SIZE = 200
+
+
+def _history_params(
+    channel: Channel,
+    cursor: Optional[str],
+) -> Dict[str, Any]:
+    params = {
+        'channel': channel.channel,
+        'oldest': format_ts(channel.last_ts),
+        'limit': BACKFILL_PAGE_SIZE,
+    }
+    if cursor:
+        params['cursor'] = cursor
+    return params
+
+
+def _next_cursor(response) -> Optional[str]:
+    if not response.get('has_more'):
+        return None
+    return (response.get('response_metadata') or {}).get('next_cursor')
+
+
+class _BaseBackfiller:
+    """Things shared between the backfillers
+
+    Messages posted while the RTM connection was down are fetched once it
+    is opened. The history since ``last_ts`` of the ``max_channels`` most
+    recently active channels is paged, at most ``max_pages`` pages each,
+    and the ``message`` actions are handed to ``dispatch`` in timestamp
+    order. They are neither journaled nor counted as received events, as
+    they have been missed rather than received. Live events are not held
+    up meanwhile, so a message received both ways is dropped by
+    :func:`dedupe_middleware`. Only channel messages are backfilled, i.e.
+    neither the replies of a thread nor its parent as a thread message.
+    """
+
+    def __init__(
+        self,
+        dispatch: Callable[[Any], None],
+        max_channels: int,
+        max_pages: int,
+    ) -> None:
+        self.dispatch = dispatch
+        self.max_channels = max_channels
+        self.max_pages = max_pages
+
+    def _channels(self, state: State) -> List[Channel]:
+        return heapq.nlargest(
+            self.max_channels,
+            state.channels.values(),
+            key=operator.attrgetter('last_ts'),
+        )
+
+    @staticmethod
+    def _page(
+        channel: Channel,
+        response,
+        messages: List[Dict[str, Any]],
+    ) -> Optional[str]:
+        """Collect the messages of a page and return the next cursor"""
+        for message in response.get('messages') or ():
+            # the messages of a channel do not tell the channel
+            message = {**message, 'channel': channel.channel}
+            if message.get('thread_ts') == message['ts']:
+                # a parent of replies is a plain message as it was when
+                # posted, since the replies are not fetched
+                del message['thread_ts']
+            messages.append(message)
+        return _next_cursor(response)
+
+    def _feed(self, web_client, messages: List[Dict[str, Any]]) -> None:
+        messages.sort(key=lambda m: parse_ts(m['ts']))
+        logger.info('backfilling messages: count=%d', len(messages))
+        for message in messages:
+            self.dispatch(ac_message({
+                'rtm_client': None,
+                'web_client': web_client,
+                'data': message,
+            }))
+
+
+class Backfiller(_BaseBackfiller):
+    """Backfill from a thread so that the event loop is not blocked
+
+    ``dispatch`` is called from that thread, so it has to hand the actions
+    over to the event loop. The histories are fetched by a pool of its own
+    ``workers`` threads, apart from the ones of :class:`ApiScheduler`.
+    """
+
+    def __init__(self, *args, workers: int = 4, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.workers = workers
+        self._stopped = threading.Event()
+
+    def start(self, state: State) -> None:
+        # a reconnection starts over from the latest channels
+        self.stop()
+        channels = self._channels(state)
+        if not channels:
+            return
+        self._stopped = threading.Event()
+        threading.Thread(
+            target=self._run,
+            args=(state.web_client, channels, self._stopped),
+            name='backfill',
+            daemon=True,
+        ).start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _run(
+        self,
+        web_client,
+        channels: List[Channel],
+        stopped: threading.Event,
+    ) -> None:
+        with concurrent.futures.ThreadPoolExecutor(
+            self.workers,
+            thread_name_prefix='backfill',
+        ) as executor:
+            histories = list(executor.map(
+                partial(self._history, web_client, stopped),
+                channels,
+            ))
+        if not stopped.is_set():
+            self._feed(web_client, [m for h in histories for m in h])
+
+    def _history(
+        self,
+        web_client,
+        stopped: threading.Event,
+        channel: Channel,
+    ) -> List[Dict[str, Any]]:
+        messages: List[Dict[str, Any]] = []
+        cursor = None
+        try:
+            for _ in range(self.max_pages):
+                if stopped.is_set():
+                    break
+                response = web_client.conversations_history(
+                    **_history_params(channel, cursor),
+                )
+                cursor = self._page(channel, response, messages)
+                if not cursor:
+                    break
+        except Exception:
+            logger.exception('failed to backfill: channel=%s', channel.channel)
+        return messages
+
+
+class AsyncBackfiller(_BaseBackfiller):
+    """Backfill from a task on the event loop"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._task: Optional['asyncio.Task[None]'] = None
+
+    def start(self, state: State) -> None:
+        # a reconnection starts over from the latest channels
+        self.stop()
+        channels = self._channels(state)
+        if channels:
+            self._task = asyncio.ensure_future(
+                self._run(state.web_client, channels),
+            )
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self, web_client, channels: List[Channel]) -> None:
+        histories = await asyncio.gather(*[
+            self._history(web_client, channel) for channel in channels
+        ])
+        self._feed(web_client, [m for h in histories for m in h])
+
+    async def _history(
+        self,
+        web_client,
+        channel: Channel,
+    ) -> List[Dict[str, Any]]:
+        messages: List[Dict[str, Any]] = []
+        cursor = None
+        try:
+            for _ in range(self.max_pages):
+                response = await web_client.conversations_history(
+                    **_history_params(channel, cursor),
+                )
+                cursor = self._page(channel, response, messages)
+                if not cursor:
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('failed to backfill: channel=%s', channel.channel)
+        return messages
 
 
 # Redux reducer like object
@@ -295,356 +1906,1868 @@ class Store:
 
 
 class Reducer:
-    def __call__(self, state, action):
-        reducer = {
+    def __init__(
+        self,
+        max_channels: int = 10000,
+        metrics: Optional[AppMetrics] = None,
+        max_threads: int = 10000,
+    ):
+        #: the max number of channels tracked in a state; the channels
+        #: without any messages for the longest time are evicted first
+        self.max_channels = max_channels
+        #: the max number of threads tracked in a state; the threads read
+        #: the longest time ago are evicted first
+        self.max_threads = max_threads
+        self.metrics = metrics
+        self._reducers = {
             ACTION_TYPES.OPEN: self.on_open,
             ACTION_TYPES.MESSAGE: self.on_message,
             ACTION_TYPES.GET_PREFS: self.on_get_pref,
+            ACTION_TYPES.PREF_CHANGE: self.on_pref_change,
+            ACTION_TYPES.REACTION_ADDED: self.on_reaction_added,
             ACTION_TYPES.REACTION_REMOVED: self.on_reaction_removed,
-        }.get(action.type_)
+            ACTION_TYPES.SUBTEAM_MEMBERS_CHANGED: (
+                self.on_subteam_members_changed
+            ),
+            ACTION_TYPES.SUBTEAM_UPDATED: self.on_subteam_updated,
+            ACTION_TYPES.THREAD_SUBSCRIPTION: self.on_thread_subscription,
+        }
+
+    def __call__(self, state, action):
+        reducer = self._reducers.get(action.type_)
         if reducer:
+            started_at = time.perf_counter()
             try:
                 return reducer(state, action)
             except Exception:
                 logger.exception('an error occured during reducing')
+                if self.metrics is not None:
+                    self.metrics.reducer_errors.inc(action.type_.name)
+                # keep the previous snapshot; nothing has been modified
+                return state
+            finally:
+                if self.metrics is not None:
+                    self.metrics.reducer_seconds.observe(
+                        time.perf_counter() - started_at,
+                        action.type_.name,
+                    )
         else:
             return state
 
     def on_open(self, state, action):
-        state.self_id = action.payload['data']['self']['id']
-        state.web_client = UncopiableProxy(action.payload['web_client'])
-        return state
+        return dataclasses.replace(
+            state,
+            self_id=action.payload['data']['self']['id'],
+            web_client=action.payload['web_client'],
+        )
 
     def on_message(self, state, action):
         latest = Message.from_payload(action.payload)
 
         if latest:
-            state.latest = latest
-            state.channels[latest.channel] = Channel(
-                channel=latest.channel,
-                last_ts=latest.ts,
+            ts = parse_ts(latest.ts)
+            threads = state.threads
+            if latest.is_thread:
+                threads = self._track_thread(
+                    threads,
+                    latest,
+                    ts,
+                    state.self_id,
+                )
+            return dataclasses.replace(
+                state,
+                latest=latest,
+                channels=self._track_channel(
+                    state.channels,
+                    latest.channel,
+                    ts,
+                ),
+                threads=threads,
             )
 
         return state
 
+    @staticmethod
+    def _evict(items, max_size, ts_of, key_of):
+        if len(items) <= max_size:
+            return items
+        # evict a tenth at once so that the scan is amortized
+        excess = len(items) - max_size * 9 // 10
+        with items.mutate() as mutation:
+            for item in heapq.nsmallest(excess, items.values(), key=ts_of):
+                del mutation[key_of(item)]
+            return mutation.finish()
+
+    def _track_channel(self, channels, channel, ts):
+        current = channels.get(channel)
+        if current is not None and current.last_ts >= ts:
+            return channels
+
+        return self._evict(
+            channels.set(channel, Channel(channel=channel, last_ts=ts)),
+            self.max_channels,
+            operator.attrgetter('last_ts'),
+            operator.attrgetter('channel'),
+        )
+
+    def _set_thread(self, threads, thread):
+        return self._evict(
+            threads.set((thread.channel, thread.thread_ts), thread),
+            self.max_threads,
+            operator.attrgetter('read_ts'),
+            operator.attrgetter('channel', 'thread_ts'),
+        )
+
+    def _track_thread(self, threads, message, ts, self_id):
+        current = threads.get((message.channel, message.thread_ts))
+        followed = current.followed if current is not None else None
+        if message.user == self_id:
+            # a reply or the parent of the user is followed
+            followed = True
+        if (
+            current is not None and
+            current.read_ts >= ts and
+            current.followed is followed
+        ):
+            return threads
+
+        return self._set_thread(threads, Thread(
+            channel=message.channel,
+            thread_ts=message.thread_ts,
+            read_ts=max(ts, current.read_ts) if current is not None else ts,
+            followed=followed,
+        ))
+
     def on_get_pref(self, state, action):
-        state.prefs = PrefsResponse(
-            UncopiableProxy(action.payload),
-            datetime.datetime.now(),
+        return dataclasses.replace(
+            state,
+            prefs=PrefsResponse.from_response(action.payload),
+        )
+
+    def on_pref_change(self, state, action):
+        if state.prefs is None:
+            # the whole prefs will be fetched soon
+            return state
+
+        data = action.payload['data']
+        prefs = state.prefs.changed(data['name'], data['value'])
+        if prefs is state.prefs:
+            return state
+        return dataclasses.replace(state, prefs=prefs)
+
+    def on_reaction_added(self, state, action):
+        return dataclasses.replace(
+            state,
+            latest=Reaction.from_addition_payload(action.payload),
         )
-        return state
 
     def on_reaction_removed(self, state, action):
-        state.latest = Reaction.from_removal_payload(action.payload)
-        return state
+        return dataclasses.replace(
+            state,
+            latest=Reaction.from_removal_payload(action.payload),
+        )
+
+    def on_subteam_members_changed(self, state, action):
+        return dataclasses.replace(
+            state,
+            latest=UsergroupChange.from_members_changed_payload(
+                action.payload,
+            ),
+        )
+
+    def on_subteam_updated(self, state, action):
+        return dataclasses.replace(
+            state,
+            latest=UsergroupChange.from_updated_payload(action.payload),
+        )
+
+    def on_thread_subscription(self, state, action):
+        # thread_marked, thread_subscribed and thread_unsubscribed, which
+        # are sent to the clients of the user, tell a subscription
+        data = action.payload['data']
+        subscription = data.get('subscription') or {}
+        channel = subscription.get('channel')
+        thread_ts = subscription.get('thread_ts')
+        if not channel or not thread_ts:
+            return state
+
+        current = state.threads.get((channel, thread_ts))
+        # replies are newer than their parent anyway
+        read_ts = parse_ts(subscription.get('last_read') or thread_ts)
+        if current is not None:
+            read_ts = max(read_ts, current.read_ts)
+        thread = Thread(
+            channel=sys.intern(channel),
+            thread_ts=thread_ts,
+            read_ts=read_ts,
+            followed=(
+                data.get('type') != 'thread_unsubscribed' and
+                subscription.get('active', True)
+            ),
+        )
+        if thread == current:
+            return state
+        return dataclasses.replace(
+            state,
+            threads=self._set_thread(state.threads, thread),
+        )
+
+
+# Action creators
+# ===============
+
+
+def ac_get_prefs(web_client):
+    def _(dispatch, get_state):
+        pref_payload = web_client.api_call('users.prefs.get')
+        dispatch(Action(ACTION_TYPES.GET_PREFS, pref_payload))
+
+    return _
+
+
+def ac_get_prefs_async(web_client):
+    async def _(dispatch, get_state):
+        pref_payload = await web_client.api_call('users.prefs.get')
+        dispatch(Action(ACTION_TYPES.GET_PREFS, pref_payload))
+
+    return _
+
+
+def _opened_warm(
+    payload,
+    dispatch,
+    get_state,
+    revalidate: Callable[[slack.WebClient], None],
+) -> bool:
+    """Dispatch ``OPEN`` alone if the prefs are known, and tell if it has"""
+    if get_state().prefs is None:
+        return False
+    # known prefs, e.g. restored from a snapshot, are revalidated after the
+    # connection is usable, without holding up the events received meanwhile
+    dispatch(Action(ACTION_TYPES.OPEN, payload))
+    revalidate(payload['web_client'])
+    return True
 
 
-# Action creators
-# ===============
+def _opened_with_prefs(payload, pref_payload) -> Batch:
+    return Batch((
+        Action(ACTION_TYPES.OPEN, payload),
+        Action(ACTION_TYPES.GET_PREFS, pref_payload),
+    ))
+
+
+def ac_open(
+    payload,
+    revalidate: Optional[Callable[[slack.WebClient], None]] = None,
+):
+    def _(dispatch, get_state):
+        def revalidate_inline(web_client):
+            dispatch(ac_get_prefs(web_client))
+
+        if _opened_warm(
+            payload,
+            dispatch,
+            get_state,
+            revalidate or revalidate_inline,
+        ):
+            return
+        try:
+            pref_payload = payload['web_client'].api_call('users.prefs.get')
+        except Exception:
+            dispatch(Action(ACTION_TYPES.OPEN, payload))
+            raise
+        dispatch(_opened_with_prefs(payload, pref_payload))
+
+    return _
+
+
+def ac_open_async(
+    payload,
+    revalidate: Optional[Callable[[slack.WebClient], None]] = None,
+):
+    async def _(dispatch, get_state):
+        def revalidate_in_background(web_client):
+            asyncio.ensure_future(
+                dispatch(ac_get_prefs_async(web_client)),
+            ).add_done_callback(_log_revalidation)
+
+        if _opened_warm(
+            payload,
+            dispatch,
+            get_state,
+            revalidate or revalidate_in_background,
+        ):
+            return
+        try:
+            pref_payload = await payload['web_client'].api_call(
+                'users.prefs.get',
+            )
+        except Exception:
+            dispatch(Action(ACTION_TYPES.OPEN, payload))
+            raise
+        dispatch(_opened_with_prefs(payload, pref_payload))
+
+    return _
+
+
+def _log_revalidation(future: 'asyncio.Future[None]') -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(
+            'failed to revalidate prefs',
+            exc_info=future.exception(),
+        )
+
+
+def ac_message(payload):
+    return Action(
+        ACTION_TYPES.MESSAGE,
+        payload,
+    )
+
+
+def ac_pref_change(payload):
+    return Action(
+        ACTION_TYPES.PREF_CHANGE,
+        payload,
+    )
+
+
+def ac_reaction_added(payload):
+    return Action(
+        ACTION_TYPES.REACTION_ADDED,
+        payload,
+    )
+
+
+def ac_reaction_removed(payload):
+    return Action(
+        ACTION_TYPES.REACTION_REMOVED,
+        payload,
+    )
+
+
+def ac_subteam_members_changed(payload):
+    return Action(
+        ACTION_TYPES.SUBTEAM_MEMBERS_CHANGED,
+        payload,
+    )
+
+
+def ac_subteam_updated(payload):
+    return Action(
+        ACTION_TYPES.SUBTEAM_UPDATED,
+        payload,
+    )
+
+
+def ac_thread_subscription(payload):
+    return Action(
+        ACTION_TYPES.THREAD_SUBSCRIPTION,
+        payload,
+    )
+
+
+#: action creators by RTM event type
+RTM_ACTION_CREATORS = {
+    'open': ac_open,
+    'message': ac_message,
+    'reaction_added': ac_reaction_added,
+    'reaction_removed': ac_reaction_removed,
+    'pref_change': ac_pref_change,
+    'subteam_members_changed': ac_subteam_members_changed,
+    'subteam_updated': ac_subteam_updated,
+    'thread_marked': ac_thread_subscription,
+    'thread_subscribed': ac_thread_subscription,
+    'thread_unsubscribed': ac_thread_subscription,
+}
+RTM_ACTION_CREATORS_ASYNC = {
+    **RTM_ACTION_CREATORS,
+    'open': ac_open_async,
+}
+
+#: a journal record of a ``users.prefs.get`` response
+JOURNAL_PREFS = 'users.prefs.get'
+
+
+def ac_journal_record(record: Record, web_client):
+    """Create the action of a journal record as if it had been received"""
+    if record.event == JOURNAL_PREFS:
+        return Action(ACTION_TYPES.GET_PREFS, record.data)
+    payload = {
+        'rtm_client': None,
+        'web_client': web_client,
+        'data': record.data,
+    }
+    if record.event == 'open':
+        # the journal holds the prefs the revalidation resulted in
+        return ac_open(payload, revalidate=_skip_revalidation)
+    return RTM_ACTION_CREATORS[record.event](payload)
+
+
+def _skip_revalidation(web_client) -> None:
+    pass
+
+
+# Subscribers
+# ===========
+
+def _summarize(value: Any) -> Any:
+    """Make a JSON friendly summary of a value held by a state
+
+    Raw payloads, i.e. private fields, API responses and the text of
+    messages are left out and collections are reduced to their size.
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    elif isinstance(value, str):
+        return value if len(value) <= 100 else value[:100] + '...'
+    elif isinstance(value, enum.Enum):
+        return value.name
+    elif isinstance(value, datetime.datetime):
+        return value.isoformat()
+    elif isinstance(value, (immutables.Map, frozenset, set, list, dict)):
+        return {'size': len(value)}
+    elif dataclasses.is_dataclass(value):
+        return {
+            f.name: _summarize(getattr(value, f.name))
+            for f in dataclasses.fields(value)
+            if not f.name.startswith('_')
+        }
+    elif isinstance(value, _EventView):
+        return {f: _summarize(getattr(value, f)) for f in value._logged_fields}
+    else:
+        return type(value).__name__
+
+
+class _JsonLine:
+    """Dump a dict as JSON only when a log record is actually emitted"""
+    __slots__ = ['data']
+
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self.data = data
+
+    def __str__(self) -> str:
+        return json.dumps(self.data, ensure_ascii=False, default=str)
+
+
+class StateChangeLogger:
+    """A subscriber logging which fields of the state have changed
+
+    Each record is a JSON line of the changed fields only. Since reducers
+    share untouched fields between states, a field has changed if and only
+    if it is not the same object. Nothing is computed unless the logger is
+    enabled for ``level``; records can be sampled by ``sample_rate`` and
+    limited to ``max_per_second``, and the number of records dropped by the
+    limit is reported by the next one.
+    """
+
+    def __init__(
+        self,
+        get_state: Callable[[], State],
+        level: int = logging.INFO,
+        sample_rate: float = 1.0,
+        max_per_second: Optional[float] = None,
+        logger: logging.Logger = logging.getLogger('state'),
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.get_state = get_state
+        self.level = level
+        self.sample_rate = sample_rate
+        self.max_per_second = max_per_second
+        self.logger = logger
+        self._clock = clock
+        self._previous = get_state()
+        self._window_started_at = 0.0
+        self._emitted_in_window = 0
+        self._dropped = 0
+
+    def __call__(self) -> None:
+        state = self.get_state()
+        previous, self._previous = self._previous, state
+
+        if not self.logger.isEnabledFor(self.level):
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        if not self._acquire():
+            self._dropped += 1
+            return
+
+        changes = {
+            f.name: _summarize(getattr(state, f.name))
+            for f in dataclasses.fields(state)
+            if getattr(state, f.name) is not getattr(previous, f.name)
+        }
+        if not changes:
+            return
+
+        data = {'time': time.time(), 'changes': changes}
+        if self._dropped:
+            data['dropped'] = self._dropped
+            self._dropped = 0
+        self.logger.log(self.level, '%s', _JsonLine(data))
+
+    def _acquire(self) -> bool:
+        if self.max_per_second is None:
+            return True
+
+        now = self._clock()
+        if now - self._window_started_at >= 1.0:
+            self._window_started_at = now
+            self._emitted_in_window = 0
+        if self._emitted_in_window >= self.max_per_second:
+            return False
+        self._emitted_in_window += 1
+        return True
+
+
+#: if the latest event is a message
+_is_message = guard(lambda s: s.is_ready and isinstance(s.latest, Message))
+#: if the latest event is a reaction
+_is_reaction = guard(lambda s: s.is_ready and isinstance(s.latest, Reaction))
+#: if the latest event is a change of a usergroup
+_is_usergroup_change = guard(lambda s: isinstance(s.latest, UsergroupChange))
+#: if the latest event happend in a thread
+_is_in_thread = guard(lambda s: s.latest.is_thread)
+#: if the event was fired by me
+_is_mine = guard(lambda s: s.latest.user == s.self_id)
+
+
+def _is_newest_in_channel(state: State) -> bool:
+    channel = state.channels.get(state.latest.channel)
+    return channel is None or channel.last_ts <= parse_ts(state.latest.ts)
+
+
+#: if no newer message in the channel has been seen; a backfilled message
+#: may come after newer ones, and marking it would unread them
+_is_newest = guard(_is_newest_in_channel)
+
+#: actions which subscribers of each kind of events are notified of
+ON_MESSAGE = [ACTION_TYPES.MESSAGE]
+ON_REACTION = [ACTION_TYPES.REACTION_ADDED, ACTION_TYPES.REACTION_REMOVED]
+ON_USERGROUP_CHANGE = [
+    ACTION_TYPES.SUBTEAM_MEMBERS_CHANGED,
+    ACTION_TYPES.SUBTEAM_UPDATED,
+]
+#: a state whose reducer has raised keeps the previous slice, which is then
+#: not handled twice
+SELECT_LATEST = operator.attrgetter('latest')
+SELECT_PREFS = operator.attrgetter('prefs')
+
+
+@_is_message
+@_is_newest
+def suppress(
+    state: State,
+    marks: Union[MarkCoalescer, AsyncMarkCoalescer],
+    decisions: MuteDecisions,
+):
+    if decisions.should_be_muted(
+        state.latest,
+        state.prefs.muted_channels,
+    ):
+        marks.mark(state.latest.channel, state.latest.ts)
+
+
+@_is_message
+@_is_in_thread
+def suppress_thread(
+    state: State,
+    marks: Union[MarkCoalescer, AsyncMarkCoalescer],
+    followed_only: bool,
+):
+    thread = state.threads.get((state.latest.channel, state.latest.thread_ts))
+    if thread is not None and (
+        # already read up to a later message
+        thread.read_ts > parse_ts(state.latest.ts) or
+        # marking a thread not followed does nothing
+        thread.followed is False or
+        (followed_only and not thread.followed)
+    ):
+        return
+    marks.mark_thread(
+        state.latest.channel,
+        state.latest.thread_ts,
+        state.latest.ts,
+    )
+
+
+def _time_card_post(state: State, rules: MessageRules) -> Optional[Dict[str, str]]:  # noqa: E501
+    """The arguments of ``chat.postMessage`` if I have posted a time card"""
+    if not rules.is_time_card(state.latest.text):
+        return None
+    return {
+        'channel': state.account.dm_to_self,
+        'text': '出勤簿を忘れずに: ' + state.account.time_card,
+    }
+
+
+@_is_message
+@_is_mine
+def suggest_time_card(state, rules: MessageRules):
+    post = _time_card_post(state, rules)
+    if post is not None:
+        state.web_client.chat_postMessage(**post)
+
+
+@_is_message
+@_is_mine
+async def suggest_time_card_async(state, rules: MessageRules):
+    post = _time_card_post(state, rules)
+    if post is not None:
+        await state.web_client.chat_postMessage(**post)
+
+
+def _reserve_reaction(
+    reactions: ReactionLedger,
+    channel: str,
+    ts: str,
+    name: str,
+) -> bool:
+    """Record a reaction about to be added, or tell it has been already"""
+    if reactions.has(channel, ts, name):
+        logger.debug(
+            'already reacted: channel=%s, ts=%s, name=%s',
+            channel,
+            ts,
+            name,
+        )
+        return False
+    # recorded before the call so that the same reaction is not added
+    # again while the call is in flight
+    reactions.add(channel, ts, name)
+    return True
+
+
+def _release_reaction(
+    reactions: ReactionLedger,
+    channel: str,
+    ts: str,
+    name: str,
+    e: Exception,
+) -> bool:
+    """Forget a reaction the call has failed to add, and tell if it has"""
+    if (
+        isinstance(e, slack.errors.SlackApiError) and
+        e.response['error'] == 'already_reacted'
+    ):
+        return False
+    reactions.discard(channel, ts, name)
+    return True
+
+
+def _add_reaction(state: State, reactions: ReactionLedger, name: str):
+    channel, ts = state.latest.channel, state.latest.ts
+    if not _reserve_reaction(reactions, channel, ts, name):
+        return
+    try:
+        state.web_client.reactions_add(
+            channel=channel,
+            name=name,
+            timestamp=ts,
+        )
+    except Exception as e:
+        if _release_reaction(reactions, channel, ts, name, e):
+            raise
+
+
+async def _add_reaction_async(
+    state: State,
+    reactions: ReactionLedger,
+    name: str,
+):
+    channel, ts = state.latest.channel, state.latest.ts
+    if not _reserve_reaction(reactions, channel, ts, name):
+        return
+    try:
+        await state.web_client.reactions_add(
+            channel=channel,
+            name=name,
+            timestamp=ts,
+        )
+    except Exception as e:
+        if _release_reaction(reactions, channel, ts, name, e):
+            raise
+
+
+def _mentioned(
+    state: State,
+    usergroups: UsergroupCache,
+) -> Tuple[bool, List[str]]:
+    """Whether I am mentioned as far as known, or the usergroups to look up
+
+    I am mentioned directly or as a member of a cached usergroup; otherwise
+    I might be a member of the usergroups not cached yet.
+    """
+    text = state.latest.text
+    if f'<@{state.self_id}>' in text:
+        return True, []
+    unknown = []
+    for usergroup in dict.fromkeys(R_SUBTEAM.findall(text)):
+        users = usergroups.get(usergroup)
+        if users is None:
+            unknown.append(usergroup)
+        elif state.self_id in users:
+            return True, []
+    return False, unknown
+
+
+def _is_member(
+    state: State,
+    usergroups: UsergroupCache,
+    usergroup: str,
+    response,
+) -> bool:
+    """Cache the users of a usergroup looked up and tell if I am one"""
+    if not response['ok']:
+        return False
+    users = frozenset(response['users'])
+    usergroups.put(usergroup, users)
+    return state.self_id in users
+
+
+@_is_message
+def mark_unread(
+    state: State,
+    usergroups: UsergroupCache,
+    reactions: ReactionLedger,
+):
+    mentioned, unknown = _mentioned(state, usergroups)
+    for usergroup in unknown:
+        response = state.web_client.usergroups_users_list(
+            usergroup=usergroup,
+        )
+        if _is_member(state, usergroups, usergroup, response):
+            mentioned = True
+            break
+    if mentioned:
+        _add_reaction(state, reactions, state.account.unread_reaction)
+
+
+@_is_message
+async def mark_unread_async(
+    state: State,
+    usergroups: UsergroupCache,
+    reactions: ReactionLedger,
+):
+    mentioned, unknown = _mentioned(state, usergroups)
+    for usergroup in unknown:
+        response = await state.web_client.usergroups_users_list(
+            usergroup=usergroup,
+        )
+        if _is_member(state, usergroups, usergroup, response):
+            mentioned = True
+            break
+    if mentioned:
+        await _add_reaction_async(
+            state,
+            reactions,
+            state.account.unread_reaction,
+        )
+
+
+@_is_usergroup_change
+def update_usergroup(state: State, usergroups: UsergroupCache):
+    if state.latest.users is None:
+        usergroups.invalidate(state.latest.usergroup)
+    else:
+        usergroups.put(state.latest.usergroup, state.latest.users)
+
+
+#: if the reaction to mark a message as unread has been removed by me
+_is_unread_reaction_removed = guard(lambda s: (
+    (s.latest.reaction == s.account.unread_reaction) and
+    (s.latest.state == REACTION_STATE.REMOVED)
+))
+
+
+@_is_reaction
+@_is_mine
+def update_reactions(state: State, reactions: ReactionLedger):
+    latest = state.latest
+    if latest.state == REACTION_STATE.ADDED:
+        reactions.add(latest.channel, latest.ts, latest.reaction)
+    else:
+        reactions.discard(latest.channel, latest.ts, latest.reaction)
+
+
+@_is_reaction
+@_is_mine
+@_is_unread_reaction_removed
+def mark_read(state: State, reactions: ReactionLedger):
+    logger.info(
+        'marking as read: channel=%s, ts=%s',
+        state.latest.channel,
+        state.latest.ts,
+    )
+    _add_reaction(state, reactions, state.account.read_reaction)
+
+
+@_is_reaction
+@_is_mine
+@_is_unread_reaction_removed
+async def mark_read_async(state: State, reactions: ReactionLedger):
+    logger.info(
+        'marking as read: channel=%s, ts=%s',
+        state.latest.channel,
+        state.latest.ts,
+    )
+    await _add_reaction_async(state, reactions, state.account.read_reaction)
+
+
+@_is_message
+@_is_mine
+def on_message(state: State, rules: MessageRules):
+    for c in rules.matched_conf(state.latest.text):
+        state.web_client.chat_postMessage(
+            channel=c['channel'],
+            text=c['text'],
+        )
+
+
+@_is_message
+@_is_mine
+async def on_message_async(state: State, rules: MessageRules):
+    for c in rules.matched_conf(state.latest.text):
+        await state.web_client.chat_postMessage(
+            channel=c['channel'],
+            text=c['text'],
+        )
+
+
+def main_debug(argv, env: Mapping[str, str]):
+    token = env['SLACK_USER_ACCESS_TOKEN']
+    client = slack.WebClient(token=token)
+    print(client.usergroups_users_list(usergroup='S0NCX9B1P'))
+
+
+def _mute_decisions(argv: argparse.Namespace) -> MuteDecisions:
+    return MuteDecisions(
+        argv.include_muted_channels,
+        argv.include_dm,
+        argv.include,
+        argv.exclude,
+        maxsize=argv.max_channels,
+    )
+
+
+def subscribe_suppressor(
+    store: Store,
+    argv: argparse.Namespace,
+    spawn: Callable[[Callable[[], None], str], None],
+    marks: MarkCoalescer,
+    rules: MessageRules,
+    usergroups: UsergroupCache,
+    reactions: ReactionLedger,
+) -> None:
+    """Subscribe the subscribers of the suppress subcommand"""
+    store.subscribe(StateChangeLogger(
+        store.get_state,
+        level=logging.getLevelName(argv.state_log_level),
+        sample_rate=argv.state_log_sample_rate,
+        max_per_second=argv.state_log_max_per_second,
+    ))
+    decisions = _mute_decisions(argv)
+    store.subscribe(lambda: suppress(store.state, marks, decisions), ON_MESSAGE, name='suppress')  # noqa: E501
+    store.subscribe(lambda: suppress_thread(store.state, marks, argv.thread_marks == 'followed'), ON_MESSAGE, name='suppress_thread')  # noqa: E501
+    # the caches are only touched by the effects, which run one by one
+    store.subscribe(lambda: spawn(partial(suggest_time_card, store.state, rules), 'suggest_time_card'), ON_MESSAGE, name='suggest_time_card')  # noqa: E501
+    store.subscribe(lambda: spawn(partial(mark_unread, store.state, usergroups, reactions), 'mark_unread'), ON_MESSAGE, name='mark_unread')  # noqa: E501
+    store.subscribe(lambda: spawn(partial(update_usergroup, store.state, usergroups), 'update_usergroup'), ON_USERGROUP_CHANGE, selector=SELECT_LATEST, name='update_usergroup')  # noqa: E501
+    store.subscribe(lambda: spawn(partial(update_reactions, store.state, reactions), 'update_reactions'), ON_REACTION, name='update_reactions')  # noqa: E501
+    store.subscribe(lambda: spawn(partial(mark_read, store.state, reactions), 'mark_read'), ON_REACTION, name='mark_read')  # noqa: E501
+    store.subscribe(lambda: spawn(partial(on_message, store.state, rules), 'on_message'), ON_MESSAGE, name='on_message')  # noqa: E501
+
+
+def subscribe_suppressor_async(
+    store: Store,
+    argv: argparse.Namespace,
+    spawn: Callable[[Optional[Awaitable[None]], str], None],
+    marks: AsyncMarkCoalescer,
+    rules: MessageRules,
+    usergroups: UsergroupCache,
+    reactions: ReactionLedger,
+) -> None:
+    """Subscribe the subscribers of the suppress subcommand with --async"""
+    store.subscribe(StateChangeLogger(
+        store.get_state,
+        level=logging.getLevelName(argv.state_log_level),
+        sample_rate=argv.state_log_sample_rate,
+        max_per_second=argv.state_log_max_per_second,
+    ))
+    decisions = _mute_decisions(argv)
+    store.subscribe(lambda: suppress(store.state, marks, decisions), ON_MESSAGE, name='suppress')  # noqa: E501
+    store.subscribe(lambda: suppress_thread(store.state, marks, argv.thread_marks == 'followed'), ON_MESSAGE, name='suppress_thread')  # noqa: E501
+    store.subscribe(lambda: spawn(suggest_time_card_async(store.state, rules), 'suggest_time_card'), ON_MESSAGE, name='suggest_time_card')  # noqa: E501
+    store.subscribe(lambda: spawn(mark_unread_async(store.state, usergroups, reactions), 'mark_unread'), ON_MESSAGE, name='mark_unread')  # noqa: E501
+    store.subscribe(lambda: update_usergroup(store.state, usergroups), ON_USERGROUP_CHANGE, selector=SELECT_LATEST, name='update_usergroup')  # noqa: E501
+    store.subscribe(lambda: update_reactions(store.state, reactions), ON_REACTION, name='update_reactions')  # noqa: E501
+    store.subscribe(lambda: spawn(mark_read_async(store.state, reactions), 'mark_read'), ON_REACTION, name='mark_read')  # noqa: E501
+    store.subscribe(lambda: spawn(on_message_async(store.state, rules), 'on_message'), ON_MESSAGE, name='on_message')  # noqa: E501
+
+
+def _rtm_callback(
+    event: str,
+    action_creator: Callable[[Dict[str, Any]], Any],
+    dispatch: Callable[[Any], Any],
+    journal: Optional[JournalWriter],
+    metrics: Optional[AppMetrics],
+    scheduler: Union[ApiScheduler, AsyncApiScheduler],
+):
+    def _(**payload):
+        if metrics is not None:
+            metrics.received(event, payload)
+        # wrapped after metrics so that they tell the time of a call itself
+        scheduler.wrap_web_client(payload['web_client'])
+        if journal is not None:
+            journal.append(event, payload['data'])
+        return dispatch(action_creator(payload))
+
+    return _
+
+
+def restore_from_journal(store: Store, path: str, since: float = 0.0) -> int:
+    """Rebuild the state from a journal and return the number of records
+
+    It has to be called before any subscriber is subscribed since the
+    records are only reduced, not reacted to again. Records received at or
+    before ``since``, e.g. when a restored snapshot was saved, are skipped.
+    """
+    count = 0
+    for record in read_journal(path):
+        # the connection is about to be opened again
+        if record.event == 'open' or record.time <= since:
+            continue
+        store.dispatch(ac_journal_record(record, None))
+        count += 1
+    return count
+
+
+def _response_data(prefs: PrefsResponse) -> Dict[str, Any]:
+    response = prefs.response
+    # a stub client responds with a plain dict
+    if isinstance(response, dict):
+        return response
+    return response.data
+
+
+def _journal_prefs(prefs: PrefsResponse) -> Dict[str, Any]:
+    """The response replaying to ``prefs``, changed since or not"""
+    data = _response_data(prefs)
+    return {
+        **data,
+        'prefs': {
+            **data['prefs'],
+            'muted_channels': ','.join(sorted(prefs.muted_channels)),
+        },
+    }
+
+
+def snapshot_of(state: State, usergroups: UsergroupCache) -> Dict[str, Any]:
+    """What a restarted process needs to handle the first events warm"""
+    prefs = None
+    if state.prefs is not None:
+        prefs = {
+            'response': _response_data(state.prefs),
+            'updated_at': state.prefs.updated_at.timestamp(),
+            # changed by pref_change events since the response
+            'muted_channels': sorted(state.prefs.muted_channels),
+        }
+    return {
+        'saved_at': time.time(),
+        'self_id': state.self_id,
+        'prefs': prefs,
+        'channels': {c.channel: c.last_ts for c in state.channels.values()},
+        'threads': [
+            [t.channel, t.thread_ts, t.read_ts, t.followed]
+            for t in state.threads.values()
+        ],
+        'usergroups': usergroups.dump(),
+    }
+
+
+def restore_snapshot(
+    store: Store,
+    usergroups: UsergroupCache,
+    path: str,
+) -> float:
+    """Load a snapshot into the state and the usergroup cache
+
+    As with :func:`restore_from_journal`, it has to be called before any
+    subscriber is subscribed. The prefs keep the time they were fetched
+    at, so that they are revalidated on connection. The time the snapshot
+    was saved at is returned.
+    """
+    data = read_snapshot(path)
+    prefs = None
+    if data['prefs'] is not None:
+        prefs = PrefsResponse(
+            response=data['prefs']['response'],
+            updated_at=datetime.datetime.fromtimestamp(
+                data['prefs']['updated_at'],
+            ),
+            muted_channels=frozenset(data['prefs']['muted_channels']),
+        )
+    store.set_state(
+        dataclasses.replace(
+            store.state,
+            self_id=data['self_id'],
+            prefs=prefs,
+            channels=immutables.Map({
+                channel: Channel(channel=channel, last_ts=last_ts)
+                for channel, last_ts in data['channels'].items()
+            }),
+            threads=immutables.Map({
+                (channel, thread_ts): Thread(
+                    channel=channel,
+                    thread_ts=thread_ts,
+                    read_ts=read_ts,
+                    followed=followed,
+                )
+                for channel, thread_ts, read_ts, followed
+                in data.get('threads', ())
+            }),
+        ),
+        silence=True,
+    )
+    usergroups.load(
+        data['usergroups'],
+        elapsed=max(0.0, time.time() - data['saved_at']),
+    )
+    return data['saved_at']
+
+
+class Snapshotter:
+    """Write a snapshot of the state every ``interval`` seconds
+
+    It runs on the event loop the RTM client runs on, as
+    :class:`PrefsRefresher` does. The records of ``journal``, if any, are
+    in the snapshot once it is written, so that the journal is rotated and
+    starts over from the prefs. The events received but not yet reduced
+    by then, which only an async pipeline has, are not restored but
+    backfilled on the next connection.
+    """
+
+    def __init__(
+        self,
+        store: Store,
+        usergroups: UsergroupCache,
+        path: str,
+        interval: float,
+        loop: asyncio.AbstractEventLoop,
+    ) -> None:
+        self.store = store
+        self.usergroups = usergroups
+        self.path = path
+        self.interval = interval
+        self.loop = loop
+        #: rotated after every snapshot
+        self.journal: Optional[JournalWriter] = None
+        #: when the last snapshot written or restored was saved
+        self.saved_at = 0.0
+        self._handle: Optional[asyncio.TimerHandle] = None
+
+    def start(self) -> None:
+        self._handle = self.loop.call_later(self.interval, self._tick)
+
+    def stop(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def save(self) -> None:
+        started_at = time.perf_counter()
+        state = self.store.state
+        data = snapshot_of(state, self.usergroups)
+        size = write_snapshot(self.path, data)
+        self.saved_at = data['saved_at']
+        if self.journal is not None:
+            self.journal.rotate()
+            if state.prefs is not None:
+                # a replay has to see the same muted channels
+                self.journal.append(JOURNAL_PREFS, _journal_prefs(state.prefs))  # noqa: E501
+        logger.debug(
+            'a snapshot has been written: path=%s, bytes=%d, elapsed=%.3fs',
+            self.path,
+            size,
+            time.perf_counter() - started_at,
+        )
+
+    def _tick(self) -> None:
+        try:
+            self.save()
+        except Exception:
+            logger.exception('failed to write a snapshot')
+        finally:
+            self.start()
+
+
+def _open_snapshot(
+    store: Store,
+    usergroups: UsergroupCache,
+    argv: argparse.Namespace,
+    account: Account,
+    loop: asyncio.AbstractEventLoop,
+) -> Optional[Snapshotter]:
+    if argv.snapshot is None:
+        return None
+
+    path = argv.snapshot.format(account=account.name)
+    snapshotter = Snapshotter(
+        store,
+        usergroups,
+        path,
+        argv.snapshot_interval,
+        loop,
+    )
+    if os.path.isfile(path):
+        try:
+            snapshotter.saved_at = restore_snapshot(store, usergroups, path)
+        except Exception:
+            # a cold start is slower but still works
+            logger.exception('failed to restore a snapshot: path=%s', path)
+        else:
+            logger.info(
+                'the state has been restored from a snapshot: account=%s, '
+                'channels=%d, usergroups=%d',
+                account.name,
+                len(store.state.channels),
+                len(usergroups),
+            )
+    return snapshotter
+
+
+def _close_snapshot(snapshotter: Optional[Snapshotter]) -> None:
+    if snapshotter is None:
+        return
+    snapshotter.stop()
+    try:
+        snapshotter.save()
+    except Exception:
+        logger.exception('failed to write a snapshot')
+
+
+def _open_journal(
+    store: Store,
+    argv: argparse.Namespace,
+    account: Account,
+    loop: asyncio.AbstractEventLoop,
+    snapshotter: Optional[Snapshotter] = None,
+) -> Optional[JournalWriter]:
+    if argv.journal is None:
+        return None
+
+    path = argv.journal.format(account=account.name)
+    if os.path.isfile(path):
+        started_at = time.perf_counter()
+        count = restore_from_journal(
+            store,
+            path,
+            # the older records are in the restored snapshot
+            since=snapshotter.saved_at if snapshotter is not None else 0.0,
+        )
+        logger.info(
+            'the state has been restored: account=%s, records=%d, '
+            'elapsed=%.3fs',
+            account.name,
+            count,
+            time.perf_counter() - started_at,
+        )
+
+    journal = JournalWriter(
+        path,
+        fsync_interval=argv.journal_fsync_interval,
+        fsync_batch_size=argv.journal_fsync_batch_size,
+    )
+    # records are appended on the event loop, and the last ones of a burst
+    # are synced there too
+    journal.sync_periodically(loop)
+
+    def _append_prefs():
+        journal.append(JOURNAL_PREFS, _journal_prefs(store.state.prefs))
+
+    # a replay has to see the same muted channels
+    store.subscribe(
+        _append_prefs,
+        [ACTION_TYPES.GET_PREFS],
+        selector=SELECT_PREFS,
+        name='journal_prefs',
+    )
+    if snapshotter is not None:
+        snapshotter.journal = journal
+    return journal
+
+
+def _middlewares(
+    argv: argparse.Namespace,
+    metrics: Optional[AppMetrics],
+) -> List[Middleware]:
+    middlewares = [thunk_middleware, logging_middleware]
+    if argv.dedupe_size > 0:
+        middlewares.append(dedupe_middleware(argv.dedupe_size))
+    if metrics is not None:
+        middlewares.append(timing_middleware(metrics))
+    return middlewares
+
+
+def _start_metrics(
+    argv: argparse.Namespace,
+) -> Tuple[Optional[AppMetrics], Optional[MetricsServer]]:
+    if argv.metrics_port is None:
+        return None, None
+
+    metrics = AppMetrics()
+    metrics_server = MetricsServer(
+        metrics.registry,
+        argv.metrics_host,
+        argv.metrics_port,
+    )
+    metrics_server.start()
+    return metrics, metrics_server
+
+
+@dataclasses.dataclass(frozen=True)
+class _BaseWiring:
+    """The parts of a suppressor shared by both modes"""
+    store: Store
+    snapshotter: Optional[Snapshotter]
+    journal: Optional[JournalWriter]
+    #: starts fetching prefs as an effect without waiting for them
+    refresh_prefs: Callable[[slack.WebClient], None]
+    #: an RTM callback per event, which counts, journals and dispatches it
+    callbacks: Dict[str, Callable[..., Any]]
+
+
+@dataclasses.dataclass(frozen=True)
+class Wiring(_BaseWiring):
+    """The parts of the suppressor of an account by :func:`wire_suppressor`"""
+    effects: EffectRunner
+    scheduler: ApiScheduler
+    marks: MarkCoalescer
+
+
+@dataclasses.dataclass(frozen=True)
+class AsyncWiring(_BaseWiring):
+    """The parts of a suppressor by :func:`wire_suppressor_async`"""
+    effects: AsyncPipeline
+    scheduler: AsyncApiScheduler
+    marks: AsyncMarkCoalescer
+
+
+def _wire_store(
+    argv: argparse.Namespace,
+    account: Account,
+    metrics: Optional[AppMetrics],
+) -> Store:
+    return Store(
+        Reducer(
+            max_channels=argv.max_channels,
+            metrics=metrics,
+            max_threads=argv.max_threads,
+        ),
+        State(account=account),
+        metrics=metrics,
+        middlewares=_middlewares(argv, metrics),
+    )
+
+
+def _scheduler_options(
+    argv: argparse.Namespace,
+    metrics: Optional[AppMetrics],
+    tiers: Mapping[Any, Tuple[float, int]],
+) -> Dict[str, Any]:
+    return dict(
+        workers=argv.api_workers,
+        max_retries=argv.api_max_retries,
+        metrics=metrics,
+        max_queue=argv.api_max_queue,
+        tiers=tiers,
+    )
+
+
+def _rtm_callbacks(
+    action_creators: Mapping[str, Callable[[Dict[str, Any]], Any]],
+    dispatch: Callable[[Any], Any],
+    journal: Optional[JournalWriter],
+    metrics: Optional[AppMetrics],
+    scheduler: Union[ApiScheduler, AsyncApiScheduler],
+) -> Dict[str, Callable[..., Any]]:
+    return {
+        event: _rtm_callback(
+            event,
+            action_creator,
+            dispatch,
+            journal,
+            metrics,
+            scheduler,
+        )
+        for event, action_creator in action_creators.items()
+    }
+
+
+def wire_suppressor(
+    argv: argparse.Namespace,
+    account: Account,
+    loop: asyncio.AbstractEventLoop,
+    metrics: Optional[AppMetrics],
+    web_app_client: WebAppClient,
+    tiers: Mapping[Any, Tuple[float, int]] = TIERS,
+) -> Wiring:
+    """Build the suppressor of an account up to its RTM callbacks
+
+    Both modes, see :func:`wire_suppressor_async`, and ``bench.py`` are
+    wired here, so that a benchmark runs the same middlewares, scheduler
+    and metrics as a suppressor does. The state is restored from a snapshot
+    and a journal, if any, before anything is subscribed. Nothing is
+    started; the connection, i.e. the RTM client, prefs refresher and
+    backfiller, is left to the caller.
+    """
+    store = _wire_store(argv, account, metrics)
+    usergroups = UsergroupCache(
+        maxsize=argv.usergroup_cache_size,
+        ttl=argv.usergroup_cache_ttl,
+    )
+    scheduler = ApiScheduler(**_scheduler_options(argv, metrics, tiers))
+    effects = EffectRunner(
+        store,
+        loop,
+        maxsize=argv.effect_queue_size,
+        metrics=metrics,
+    )
+    marks = MarkCoalescer(
+        web_app_client,
+        window=argv.mark_window,
+        max_batch=argv.mark_batch_size,
+        scheduler=scheduler,
+    )
+
+    def refresh_prefs(web_client: slack.WebClient) -> None:
+        # only the GET_PREFS action goes through the store
+        effects.spawn_thunk(ac_get_prefs(web_client), 'get_prefs')
+
+    snapshotter = _open_snapshot(store, usergroups, argv, account, loop)
+    journal = _open_journal(store, argv, account, loop, snapshotter)
+    subscribe_suppressor(
+        store,
+        argv,
+        effects.spawn,
+        marks,
+        MessageRules(account.on_message_conf),
+        usergroups,
+        ReactionLedger(maxsize=argv.reaction_ledger_size),
+    )
+    callbacks = _rtm_callbacks(
+        {
+            **RTM_ACTION_CREATORS,
+            'open': partial(ac_open, revalidate=refresh_prefs),
+        },
+        store.dispatch,
+        journal,
+        metrics,
+        scheduler,
+    )
+    return Wiring(
+        store=store,
+        effects=effects,
+        scheduler=scheduler,
+        marks=marks,
+        snapshotter=snapshotter,
+        journal=journal,
+        refresh_prefs=refresh_prefs,
+        callbacks=callbacks,
+    )
+
+
+def wire_suppressor_async(
+    argv: argparse.Namespace,
+    account: Account,
+    loop: asyncio.AbstractEventLoop,
+    metrics: Optional[AppMetrics],
+    web_app_client: AsyncWebAppClient,
+    tiers: Mapping[Any, Tuple[float, int]] = TIERS,
+) -> AsyncWiring:
+    """Build the suppressor of an account with --async
+
+    See :func:`wire_suppressor`. The events are dispatched through an
+    :class:`AsyncPipeline` instead.
+    """
+    store = _wire_store(argv, account, metrics)
+    usergroups = UsergroupCache(
+        maxsize=argv.usergroup_cache_size,
+        ttl=argv.usergroup_cache_ttl,
+    )
+    scheduler = AsyncApiScheduler(**_scheduler_options(argv, metrics, tiers))
+    effects = AsyncPipeline(
+        store,
+        concurrency=argv.concurrency,
+        metrics=metrics,
+    )
+    marks = AsyncMarkCoalescer(
+        web_app_client,
+        effects.spawn,
+        window=argv.mark_window,
+        max_batch=argv.mark_batch_size,
+        scheduler=scheduler,
+    )
+
+    def refresh_prefs(web_client: slack.WebClient) -> None:
+        # only the GET_PREFS action goes through the store
+        effects.spawn_thunk(ac_get_prefs_async(web_client), 'get_prefs')
+
+    snapshotter = _open_snapshot(store, usergroups, argv, account, loop)
+    journal = _open_journal(store, argv, account, loop, snapshotter)
+    subscribe_suppressor_async(
+        store,
+        argv,
+        effects.spawn,
+        marks,
+        MessageRules(account.on_message_conf),
+        usergroups,
+        ReactionLedger(maxsize=argv.reaction_ledger_size),
+    )
+    callbacks = _rtm_callbacks(
+        {
+            **RTM_ACTION_CREATORS_ASYNC,
+            'open': partial(ac_open_async, revalidate=refresh_prefs),
+        },
+        effects.put,
+        journal,
+        metrics,
+        scheduler,
+    )
+    return AsyncWiring(
+        store=store,
+        effects=effects,
+        scheduler=scheduler,
+        marks=marks,
+        snapshotter=snapshotter,
+        journal=journal,
+        refresh_prefs=refresh_prefs,
+        callbacks=callbacks,
+    )
+
 
+def main_suppress(argv, env: Mapping[str, str]):
+    if argv.accounts is not None or argv.token_store is not None:
+        return main_suppress_many(argv, env)
+    if argv.run_async:
+        return main_suppress_async(argv, env)
 
-def ac_open(payload):
-    def _(dispatch, get_state):
-        dispatch(Action(ACTION_TYPES.OPEN, payload))
+    # before anything is started so that a bad config fails fast
+    account = Account.from_env(env)
+    metrics, metrics_server = _start_metrics(argv)
+    loop = asyncio.get_event_loop()
+    rtm_client = slack.RTMClient(token=account.token, loop=loop)
 
-        # get prefs
-        web_client = payload['web_client']
-        pref_payload = web_client.api_call('users.prefs.get')
-        dispatch(Action(ACTION_TYPES.GET_PREFS, pref_payload))
+    web_app_client = WebAppClient(
+        account.web_app_cookie,
+        account.web_app_token,
+        account.web_app_base_url,
+        pool_size=argv.web_app_pool_size,
+        timeout=argv.web_app_timeout,
+        metrics=metrics,
+    )
+    wiring = wire_suppressor(
+        argv,
+        account,
+        loop,
+        metrics,
+        web_app_client,
+    )
+    store = wiring.store
+    prefs_refresher = PrefsRefresher(
+        store,
+        wiring.refresh_prefs,
+        account.get_prefs_interval,
+        loop,
+    )
 
-    return _
+    if store.state.prefs is None:
+        # fetched before connecting, the prefs are only revalidated off the
+        # event loop once connected
+        web_client = slack.WebClient(token=account.token)
+        if metrics is not None:
+            metrics.instrument_web_client(web_client)
+        wiring.scheduler.wrap_web_client(web_client)
+        store.dispatch(ac_get_prefs(web_client))
 
+    for event, callback in wiring.callbacks.items():
+        rtm_client.run_on(event=event)(callback)
 
-def ac_message(payload):
-    def _(dispatch, get_state):
-        state = get_state()
-        if state.prefs and state.prefs.is_outdated:
-            pref_payload = state.web_client.api_call('users.prefs.get')
-            dispatch(Action(ACTION_TYPES.GET_PREFS, pref_payload))
+    # backfilled messages are reduced on the event loop as RTM events are
+    backfiller = Backfiller(
+        lambda action: loop.call_soon_threadsafe(store.dispatch, action),
+        max_channels=argv.backfill_channels,
+        max_pages=argv.backfill_pages,
+        workers=argv.backfill_workers,
+    )
+    if argv.backfill_channels > 0:
+        store.subscribe(lambda: backfiller.start(store.state), [ACTION_TYPES.OPEN], name='backfill')  # noqa: E501
 
-        dispatch(Action(
-            ACTION_TYPES.MESSAGE,
-            payload,
-        ))
+    wiring.effects.start()
+    prefs_refresher.start()
+    if wiring.snapshotter is not None:
+        wiring.snapshotter.start()
+    try:
+        return rtm_client.start()
+    finally:
+        backfiller.stop()
+        prefs_refresher.stop()
+        wiring.effects.stop(timeout=argv.web_app_timeout)
+        _close_snapshot(wiring.snapshotter)
+        wiring.marks.flush()
+        wiring.scheduler.stop(timeout=argv.web_app_timeout)
+        web_app_client.close()
+        if wiring.journal is not None:
+            wiring.journal.close()
+        if metrics_server is not None:
+            metrics_server.stop()
 
-    return _
 
+class _AsyncSuppressor:
+    """The suppressor of an account on an event loop shared with others"""
 
-def ac_reaction_removed(payload):
-    return Action(
-        ACTION_TYPES.REACTION_REMOVED,
-        payload,
-    )
+    def __init__(
+        self,
+        argv: argparse.Namespace,
+        account: Account,
+        loop: asyncio.AbstractEventLoop,
+        metrics: Optional[AppMetrics],
+        web_app_session: Optional[aiohttp.ClientSession],
+    ) -> None:
+        self.account = account
+        self.loop = loop
+        self.rtm_client = slack.RTMClient(
+            token=account.token,
+            run_async=True,
+            loop=loop,
+        )
+        self.web_app_client = AsyncWebAppClient(
+            account.web_app_cookie,
+            account.web_app_token,
+            account.web_app_base_url,
+            pool_size=argv.web_app_pool_size,
+            timeout=argv.web_app_timeout,
+            metrics=metrics,
+            session=web_app_session,
+        )
+        wiring = wire_suppressor_async(
+            argv,
+            account,
+            loop,
+            metrics,
+            self.web_app_client,
+        )
+        self.store = wiring.store
+        self.pipeline = wiring.effects
+        self.scheduler = wiring.scheduler
+        self.marks = wiring.marks
+        self.snapshotter = wiring.snapshotter
+        self.journal = wiring.journal
+        self.callbacks = wiring.callbacks
+        self.prefs_refresher = PrefsRefresher(
+            self.store,
+            wiring.refresh_prefs,
+            account.get_prefs_interval,
+            loop,
+        )
+        self.backfiller = AsyncBackfiller(
+            self.pipeline.put,
+            max_channels=argv.backfill_channels,
+            max_pages=argv.backfill_pages,
+        )
+        if argv.backfill_channels > 0:
+            self.store.subscribe(lambda: self.backfiller.start(self.store.state), [ACTION_TYPES.OPEN], name='backfill')  # noqa: E501
+        self._consumer: Optional['asyncio.Task[None]'] = None
 
+    def received(self, event: str, payload: Dict[str, Any]) -> None:
+        self.callbacks[event](**payload)
 
-# Subscribers
-# ===========
+    def start(self) -> 'asyncio.Future[Any]':
+        self._consumer = self.loop.create_task(self.pipeline.run())
+        self.scheduler.start()
+        self.prefs_refresher.start()
+        if self.snapshotter is not None:
+            self.snapshotter.start()
+        return self.rtm_client.start()
 
-#: if the latest event is a message
-_is_message = guard(lambda s: s.is_ready and isinstance(s.latest, Message))
-#: if the latest event is a reaction
-_is_reaction = guard(lambda s: s.is_ready and isinstance(s.latest, Reaction))
-#: if the latest event happend in a thread
-_is_in_thread = guard(lambda s: s.latest.thread_ts is not None)
-#: if the event was fired by me
-_is_mine = guard(lambda s: s.latest.user == s.self_id)
+    async def close(self) -> None:
+        self.backfiller.stop()
+        self.prefs_refresher.stop()
+        _close_snapshot(self.snapshotter)
+        self.marks.flush()
+        await self.pipeline.drain()
+        await self.scheduler.close()
+        if self._consumer is not None:
+            self._consumer.cancel()
+        await self.web_app_client.close()
+        if self.journal is not None:
+            self.journal.close()
 
 
-@_is_message
-def suppress(
-    state: State,
-    client: WebAppClient,
-    include_muted_channels: bool,
-    include_dm: bool,
-    include: List[str],
-    exclude: List[str],
+def _rtm_router_async(
+    event: str,
+    suppressors: Dict[int, _AsyncSuppressor],
 ):
-    def should_be_muted(
-        state: State,
-        include_muted_channels: bool,
-        include_dm: bool,
-        include: List[str],
-        exclude: List[str],
-    ):
-        if not include_dm and state.latest.channel[0] in ['G', 'U']:
-            return False
+    # callbacks are shared by every RTM client, so an event is routed by
+    # the client which has received it
+    async def _(**payload):
+        suppressor = suppressors.get(id(payload['rtm_client']))
+        if suppressor is not None:
+            suppressor.received(event, payload)
 
-        return (
-            include_muted_channels and
-            state.latest.channel in state.prefs.muted_channels
-        ) or (
-            include and
-            state.latest.channel in include
-        ) or (
-            exclude and
-            state.latest.channel not in exclude
-        )
+    return _
 
-    if should_be_muted(state, include_muted_channels, include_dm, include, exclude):
-        response = client.request(
-            'POST',
-            '/api/conversations.mark',
-            {
-                'channel': state.latest.channel,
-                'ts': state.latest.ts,
-            },
-        )
-        if response.status_code != 200:
-            logger.error(
-                'Failed to call the API: status_code=%s, content=%s',
-                response.status_code,
-                response.content,
-            )
-        else:
-            logger.info(
-                'a message has been suppressed: channel=%s, ts=%s',
-                state.latest.channel,
-                state.latest.ts,
-            )
 
+def _run_accounts_async(argv, accounts: List[Account]):
+    """Run the suppressors of accounts on an event loop"""
+    metrics, metrics_server = _start_metrics(argv)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
 
-@_is_message
-@_is_in_thread
-def suppress_thread(state: State, client: WebAppClient):
-    response = client.request(
-        'POST',
-        '/api/subscriptions.thread.mark',
-        {
-            'channel': state.latest.channel,
-            'thread_ts': state.latest.thread_ts,
-            'ts': state.latest.ts,
-            'read': '1',
-        },
-    )
-    if (
-        (response.status_code != 200) or
-        (not response.json()['ok'])
-    ):
-        logger.error(
-            'Failed to call the API: status_code=%s, content=%s',
-            response.status_code,
-            response.content,
+    web_app_session = None
+    if len(accounts) > 1:
+        # made on the loop; cookies are sent per account instead of kept
+        web_app_session = loop.run_until_complete(_shared_web_app_session(
+            pool_size=argv.web_app_pool_size,
+            timeout=argv.web_app_timeout,
+        ))
+
+    suppressors = {}
+    for account in accounts:
+        suppressor = _AsyncSuppressor(
+            argv,
+            account,
+            loop,
+            metrics,
+            web_app_session,
         )
-    else:
-        logger.info(
-            'the message in a thread has been suppressed: channel=%s, ts=%s',
-            state.latest.channel,
-            state.latest.ts,
+        suppressors[id(suppressor.rtm_client)] = suppressor
+    for event in RTM_ACTION_CREATORS_ASYNC:
+        slack.RTMClient.run_on(event=event)(
+            _rtm_router_async(event, suppressors),
         )
 
+    def _stop():
+        for suppressor in suppressors.values():
+            suppressor.rtm_client.stop()
 
-@_is_message
-@_is_mine
-def suggest_time_card(state):
-    if (
-        'おわり' in state.latest.text or
-        '終わり' in state.latest.text or
-        '開始' in state.latest.text or
-        'かいし' in state.latest.text
-    ):
-        text = '出勤簿を忘れずに: ' + os.environ['APP_TIME_CARD']
-        state.web_client.chat_postMessage(
-            channel=os.environ['APP_DM_TO_SELF'],
-            text=text,
-        )
-
+    futures = [s.start() for s in suppressors.values()]
+    if os.name != 'nt' and threading.current_thread() is threading.main_thread():  # noqa: E501
+        # every client has replaced the handlers of the previous one
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, _stop)
+    try:
+        return loop.run_until_complete(asyncio.gather(*futures))
+    finally:
+        for suppressor in suppressors.values():
+            loop.run_until_complete(suppressor.close())
+        if web_app_session is not None:
+            loop.run_until_complete(web_app_session.close())
+        if metrics_server is not None:
+            metrics_server.stop()
 
-@_is_message
-def mark_unread(state: State):
-    def in_usergroup(
-        client: slack.WebClient,
-        user: str,
-        text: str,
-    ):
-        for usergroup in R_SUBTEAM.findall(text):
-            resp = client.usergroups_users_list(usergroup=usergroup)
-            if resp['ok'] and (user in resp['users']):
-                return True
-        else:
-            return False
 
-    if (
-        (f'<@{state.self_id}>' in state.latest.text) or
-        in_usergroup(state.web_client, state.self_id, state.latest.text)
-    ):
-        name = os.environ['APP_UNREAD_REACTION']
-        try:
-            state.web_client.reactions_add(
-                channel=state.latest.channel,
-                name=name,
-                timestamp=state.latest.ts,
-            )
-        except slack.errors.SlackApiError as e:
-            if e.response['error'] != 'already_reacted':
-                raise
+def main_suppress_async(argv, env: Mapping[str, str]):
+    return _run_accounts_async(argv, [Account.from_env(env)])
 
 
-@_is_reaction
-@_is_mine
-@guard(lambda s: (
-    (s.latest.reaction == os.environ['APP_UNREAD_REACTION']) and
-    (s.latest.state == REACTION_STATE.REMOVED)
-))
-def mark_read(state: State):
-    name = os.environ['APP_READ_REACTION']
-    try:
-        logger.info(
-            'marking as read: channel=%s, ts=%s',
-            state.latest.channel,
-            state.latest.ts,
+def _run_shard(argv, accounts: List[Account], index: int) -> None:
+    if argv.metrics_port is not None:
+        argv = argparse.Namespace(
+            **{**vars(argv), 'metrics_port': argv.metrics_port + index},
         )
-        state.web_client.reactions_add(
-            channel=state.latest.channel,
-            name=name,
-            timestamp=state.latest.ts,
-        )
-    except slack.errors.SlackApiError as e:
-        if e.response['error'] != 'already_reacted':
-            raise
+    logger.info(
+        'running accounts: shard=%d, accounts=%s',
+        index,
+        [a.name for a in accounts],
+    )
+    _run_accounts_async(argv, accounts)
 
 
-@_is_message
-@_is_mine
-def on_message(state: State, conf: List[Dict[str, str]]):
-    for c in conf:
-        method = getattr(state.latest.text, c['method'])
-        assert callable(method)
-        if method(*c['arguments']):
-            state.web_client.chat_postMessage(
-                channel=c['channel'],
-                text=c['text'],
-            )
+def _load_accounts(argv, env: Mapping[str, str]) -> List[Account]:
+    confs = []
+    if argv.accounts is not None:
+        with open(argv.accounts) as f:
+            confs.extend(json.load(f))
+    if argv.token_store is not None:
+        if 'APP_TOKEN_STORE_KEY' not in env:
+            raise ConfigError('APP_TOKEN_STORE_KEY not set')
+        store = tokenstore.TokenStore(
+            argv.token_store,
+            env['APP_TOKEN_STORE_KEY'],
+        )
+        for conf in store.load():
+            # the web app session in the environment is someone else's
+            missing = [k for k in tokenstore.WEB_APP_ENV if not conf.get(k)]
+            if missing:
+                logger.warning(
+                    'skipping a stored account without its web app '
+                    'session: account=%s, missing=%s',
+                    conf['name'],
+                    missing,
+                )
+                continue
+            confs.append(conf)
+    return Account.from_confs(confs, env)
 
 
-def main_debug(argv):
-    token = os.environ['SLACK_USER_ACCESS_TOKEN']
-    client = slack.WebClient(token=token)
-    print(client.usergroups_users_list(usergroup='S0NCX9B1P'))
+def main_suppress_many(argv, env: Mapping[str, str]):
+    accounts = _load_accounts(argv, env)
+    for option, path in [
+        ('--journal', argv.journal),
+        ('--snapshot', argv.snapshot),
+    ]:
+        if path is not None and len(accounts) > 1 and '{account}' not in path:  # noqa: E501
+            raise ValueError(f'{option} has to contain {{account}}')
+
+    shards = [
+        accounts[i::argv.processes]
+        for i in range(min(argv.processes, len(accounts)))
+    ]
+    if len(shards) == 1:
+        return _run_shard(argv, shards[0], 0)
 
+    # a shard per process, each of which has its own event loop
+    processes = [
+        multiprocessing.Process(
+            target=_run_shard,
+            args=(argv, shard, i),
+            name=f'shard-{i}',
+        )
+        for i, shard in enumerate(shards)
+    ]
 
-def main_suppress(argv):
-    token = os.environ['SLACK_USER_ACCESS_TOKEN']
-    rtm_client = slack.RTMClient(token=token)
+    def _terminate(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
 
-    web_app_cookie = os.environ['SLACK_WEB_APP_COOKIE']
-    web_app_token = os.environ['SLACK_WEB_APP_TOKEN']
-    web_app_base_url = os.environ['SLACK_WEB_APP_BASE_URL']
-    web_app_client = WebAppClient(
-        web_app_cookie,
-        web_app_token,
-        web_app_base_url,
-    )
-    on_message_conf = json.loads(os.environ.get('APP_ON_MESSAGE_CONF', '[]'))
+    for process in processes:
+        process.start()
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        _terminate(None, None)
 
-    store = Store(Reducer())
 
-    store.subscribe(lambda: logger.info(
-        'state=%s',
-        pprint.pformat(store.state)
-    ))
-    store.subscribe(lambda: suppress(store.state, web_app_client, argv.include_muted_channels, argv.include_dm, argv.include, argv.exclude))  # noqa: E501
-    store.subscribe(lambda: suppress_thread(store.state, web_app_client))
-    store.subscribe(lambda: suggest_time_card(store.state))
-    store.subscribe(lambda: mark_unread(store.state))
-    store.subscribe(lambda: mark_read(store.state))
-    store.subscribe(lambda: on_message(store.state, on_message_conf))
-
-    rtm_client.run_on(event='open')(lambda **payload: store.dispatch(
-        ac_open(payload),
-    ))
-    rtm_client.run_on(event='message')(lambda **payload: store.dispatch(
-        ac_message(payload),
-    ))
-    rtm_client.run_on(event='reaction_removed')(lambda **payload: store.dispatch(  # noqa: E501
+def main_replay(argv, env: Mapping[str, str]):
+    # the credentials are never used
+    account = Account.from_env({
+        'SLACK_USER_ACCESS_TOKEN': '',
+        'SLACK_WEB_APP_COOKIE': '',
+        'SLACK_WEB_APP_TOKEN': '',
+        'SLACK_WEB_APP_BASE_URL': '',
+        # prefs are never refreshed in a replay
+        'APP_GET_PREFS_INT': '3600',
+        **env,
+    })
+    metrics, metrics_server = _start_metrics(argv)
+    if argv.base_url is None:
+        web_client = StubWebClient()
+        web_app_client = StubWebAppClient()
+    else:
+        # never send the real credentials anywhere but to Slack
+        web_client = slack.WebClient(
+            token='xoxp-replay',
+            base_url=argv.base_url.rstrip('/') + '/api/',
+        )
+        web_app_client = WebAppClient(
+            'd=replay',
+            'xoxc-replay',
+            argv.base_url,
+            pool_size=argv.web_app_pool_size,
+            timeout=argv.web_app_timeout,
+            metrics=metrics,
+        )
+    if metrics is not None:
+        metrics.instrument_web_client(web_client)
+    rules = MessageRules(account.on_message_conf)
+    marks = MarkCoalescer(
+        web_app_client,
+        window=argv.mark_window,
+        max_batch=argv.mark_batch_size,
+    )
+    usergroups = UsergroupCache(
+        maxsize=argv.usergroup_cache_size,
+        ttl=argv.usergroup_cache_ttl,
+    )
 
-        ac_reaction_removed(payload),
-    ))
+    store = Store(
+        Reducer(
+            max_channels=argv.max_channels,
+            metrics=metrics,
+            max_threads=argv.max_threads,
+        ),
+        State(account=account),
+        metrics=metrics,
+        middlewares=_middlewares(argv, metrics),
+    )
+    reactions = ReactionLedger(maxsize=argv.reaction_ledger_size)
+    subscribe_suppressor(
+        store,
+        argv,
+        run_inline,
+        marks,
+        rules,
+        usergroups,
+        reactions,
+    )
 
-    return rtm_client.start()
+    # records are dispatched back to back, not at the recorded pace
+    events: Counter = Counter()
+    started_at = time.perf_counter()
+    try:
+        for record in read_journal(argv.journal):
+            store.dispatch(ac_journal_record(record, web_client))
+            events[record.event] += 1
+    finally:
+        marks.flush()
+        web_app_client.close()
+        if metrics_server is not None:
+            metrics_server.stop()
+    elapsed = time.perf_counter() - started_at
 
+    logger.info(
+        'the journal has been replayed: records=%d, elapsed=%.3fs, '
+        'records_per_second=%.1f, events=%s',
+        sum(events.values()),
+        elapsed,
+        sum(events.values()) / elapsed if elapsed else 0.0,
+        dict(events),
+    )
+    if argv.base_url is None:
+        logger.info(
+            'stubbed calls: web_api=%s, web_app=%s',
+            dict(web_client.calls),
+            dict(web_app_client.calls),
+        )
+    if metrics is not None:
+        # the endpoint is gone with the process
+        sys.stdout.write(metrics.registry.render())
 
-def main(argv):
-    # configure a logging facility
-    logging.config.dictConfig({
-        'version': 1,
-        'disable_existing_loggers': False,
-        'handlers': {
-            'console': {
-                'level': 'INFO',
-                'class': 'logging.StreamHandler',
-                'formatter': 'default',
-                'filters': [],
-            },
-        },
-        'formatters': {
-            'default': {
-                'format': '%(asctime)s %(levelname)-8s %(name)-15s %(message)s',  # noqa: E501
-                'datefmt': '%Y-%m-%d %H:%M:%S'
-            },
-        },
-        'root': {
-            'level': 'INFO',
-            'handlers': ['console'],
-        },
-    })
 
+def build_parser() -> argparse.ArgumentParser:
     # create a parent parser
     parser = argparse.ArgumentParser()
+    profiling.add_arguments(parser)
     subparsers = parser.add_subparsers(required=True)
 
-    # configure a subparser for supress
-    parser_suppress = subparsers.add_parser('suppress')
-    parser_suppress.add_argument(
+    # options shared by the subcommands which run the suppressor
+    parser_suppressor = argparse.ArgumentParser(add_help=False)
+    parser_suppressor.add_argument(
         '--include-dm',
         action='store_true',
         default=False,
     )
-    parser_suppress.add_argument(
+    parser_suppressor.add_argument(
         '--include-muted-channels',
         action='store_true',
         default=True,
     )
-    inc_exc_group = parser_suppress.add_mutually_exclusive_group()
+    inc_exc_group = parser_suppressor.add_mutually_exclusive_group()
     inc_exc_group.add_argument(
         '--include',
         help='channels to be suppressed',
@@ -657,25 +3780,324 @@ def main(argv):
         nargs='*',
         type=str,
     )
+    parser_suppressor.add_argument(
+        '--web-app-pool-size',
+        help='max number of keep-alive connections to the web app',
+        default=10,
+        type=int,
+    )
+    parser_suppressor.add_argument(
+        '--web-app-timeout',
+        help='timeout in seconds for a request to the web app',
+        default=10.0,
+        type=float,
+    )
+    parser_suppressor.add_argument(
+        '--usergroup-cache-size',
+        help='max number of usergroups whose members are cached',
+        default=256,
+        type=int,
+    )
+    parser_suppressor.add_argument(
+        '--usergroup-cache-ttl',
+        help='seconds until cached usergroup members expire',
+        default=3600.0,
+        type=float,
+    )
+    parser_suppressor.add_argument(
+        '--reaction-ledger-size',
+        help='max number of reactions by the user remembered not to be added again',  # noqa: E501
+        default=10000,
+        type=int,
+    )
+    parser_suppressor.add_argument(
+        '--mark-window',
+        help=(
+            'seconds to wait for newer messages before marking a channel '
+            'or a thread as read'
+        ),
+        default=1.0,
+        type=float,
+    )
+    parser_suppressor.add_argument(
+        '--mark-batch-size',
+        help='number of pending channels and threads to mark at once',
+        default=50,
+        type=int,
+    )
+    parser_suppressor.add_argument(
+        '--max-channels',
+        help='max number of channels tracked in memory',
+        default=10000,
+        type=int,
+    )
+    parser_suppressor.add_argument(
+        '--max-threads',
+        help='max number of threads whose read state is tracked in memory',
+        default=10000,
+        type=int,
+    )
+    parser_suppressor.add_argument(
+        '--thread-marks',
+        help=(
+            'threads to mark as read; "all" but the ones known not to be '
+            'followed, or only the ones "followed" for sure'
+        ),
+        default='all',
+        choices=['all', 'followed'],
+    )
+    parser_suppressor.add_argument(
+        '--dedupe-size',
+        help='number of recent events remembered to drop duplicates; 0 disables',  # noqa: E501
+        default=1000,
+        type=int,
+    )
+    parser_suppressor.add_argument(
+        '--metrics-port',
+        help='a port to serve metrics on at /metrics; disabled by default',
+        default=None,
+        type=int,
+    )
+    parser_suppressor.add_argument(
+        '--metrics-host',
+        help='an address to serve metrics on',
+        default='0.0.0.0',
+        type=str,
+    )
+    parser_suppressor.add_argument(
+        '--state-log-level',
+        help='log level of state changes',
+        default='INFO',
+        choices=['DEBUG', 'INFO', 'WARNING'],
+    )
+    parser_suppressor.add_argument(
+        '--state-log-sample-rate',
+        help='ratio of state changes to be logged',
+        default=1.0,
+        type=float,
+    )
+    parser_suppressor.add_argument(
+        '--state-log-max-per-second',
+        help='max number of state changes logged per second',
+        default=None,
+        type=float,
+    )
+    # configure a subparser for supress
+    parser_suppress = subparsers.add_parser(
+        'suppress',
+        parents=[parser_suppressor],
+    )
+    parser_suppress.add_argument(
+        '--async',
+        help='process events on an asyncio pipeline',
+        dest='run_async',
+        action='store_true',
+        default=False,
+    )
+    parser_suppress.add_argument(
+        '--concurrency',
+        help='max number of API calls in flight (only with --async)',
+        default=8,
+        type=int,
+    )
+    parser_suppress.add_argument(
+        '--accounts',
+        help=(
+            'a JSON file of accounts to run in one process, each of which '
+            'is an object of the environment variables and "name"; implies '
+            '--async'
+        ),
+        default=None,
+        type=str,
+    )
+    parser_suppress.add_argument(
+        '--token-store',
+        help=(
+            'an encrypted file of the accounts onboarded through token_app, '
+            'run together with --accounts if both are given; the key is '
+            'taken from APP_TOKEN_STORE_KEY; implies --async'
+        ),
+        default=None,
+        type=str,
+    )
+    parser_suppress.add_argument(
+        '--processes',
+        help=(
+            'number of processes the accounts are sharded across; the '
+            'metrics port is incremented for each'
+        ),
+        default=1,
+        type=int,
+    )
+    parser_suppress.add_argument(
+        '--api-workers',
+        help='max number of API calls sent at once by the scheduler',
+        default=4,
+        type=int,
+    )
+    parser_suppress.add_argument(
+        '--api-max-retries',
+        help='max number of retries of a call answered with 429',
+        default=3,
+        type=int,
+    )
+    parser_suppress.add_argument(
+        '--api-max-queue',
+        help=(
+            'max number of calls of a method waiting in the scheduler; a '
+            'newer mark of a channel replaces the waiting one'
+        ),
+        default=1000,
+        type=int,
+    )
+    parser_suppress.add_argument(
+        '--effect-queue-size',
+        help=(
+            'max number of side effects of the subscribers waiting for the '
+            'effect thread without --async'
+        ),
+        default=10000,
+        type=int,
+    )
+    parser_suppress.add_argument(
+        '--journal',
+        help=(
+            'a file to append every RTM event to; the state is restored '
+            'from it on start up if it exists. With --snapshot it is moved '
+            'to <path>.1 after every snapshot'
+        ),
+        default=None,
+        type=str,
+    )
+    parser_suppress.add_argument(
+        '--journal-fsync-interval',
+        help='max seconds between syncs of the journal to the disk',
+        default=1.0,
+        type=float,
+    )
+    parser_suppress.add_argument(
+        '--journal-fsync-batch-size',
+        help='max number of records appended between syncs of the journal',
+        default=100,
+        type=int,
+    )
+    parser_suppress.add_argument(
+        '--backfill-channels',
+        help=(
+            'max number of the most recently active channels whose missed '
+            'messages are fetched on connection; 0 disables'
+        ),
+        default=100,
+        type=int,
+    )
+    parser_suppress.add_argument(
+        '--backfill-pages',
+        help=f'max number of pages of {BACKFILL_PAGE_SIZE} messages fetched per channel',  # noqa: E501
+        default=5,
+        type=int,
+    )
+    parser_suppress.add_argument(
+        '--backfill-workers',
+        help='number of threads fetching the histories to backfill (only without --async)',  # noqa: E501
+        default=4,
+        type=int,
+    )
+    parser_suppress.add_argument(
+        '--snapshot',
+        help=(
+            'a file to write a snapshot of the state to periodically and '
+            'on exit; it is loaded on start up if it exists'
+        ),
+        default=None,
+        type=str,
+    )
+    parser_suppress.add_argument(
+        '--snapshot-interval',
+        help='seconds between snapshots',
+        default=60.0,
+        type=float,
+    )
     parser_suppress.set_defaults(func=main_suppress)
 
+    # configure a subparser for replay
+    parser_replay = subparsers.add_parser(
+        'replay',
+        parents=[parser_suppressor],
+    )
+    parser_replay.add_argument(
+        'journal',
+        help='a journal written by suppress --journal',
+        type=str,
+    )
+    parser_replay.add_argument(
+        '--base-url',
+        help=(
+            'a local server to send the API calls to, e.g. '
+            'http://localhost:8080; they are only counted by default'
+        ),
+        default=None,
+        type=str,
+    )
+    parser_replay.set_defaults(func=main_replay)
+
     # configure a subparser for debug
     parser_debug = subparsers.add_parser('debug')
     parser_debug.set_defaults(func=main_debug)
 
+    return parser
+
+
+def main(argv, env: Optional[Mapping[str, str]] = None):
+    parser = build_parser()
     args = parser.parse_args(argv or [''])
-    return args.func(args)
 
+    # configure a logging facility
+    logging.config.dictConfig({
+        'version': 1,
+        'disable_existing_loggers': False,
+        'handlers': {
+            'console': {
+                'level': 'INFO',
+                'class': 'logging.StreamHandler',
+                'formatter': 'default',
+                'filters': [],
+            },
+            'state': {
+                'level': 'DEBUG',
+                'class': 'logging.StreamHandler',
+                'formatter': 'json_lines',
+                'filters': [],
+            },
+        },
+        'formatters': {
+            'default': {
+                'format': '%(asctime)s %(levelname)-8s %(name)-15s %(message)s',  # noqa: E501
+                'datefmt': '%Y-%m-%d %H:%M:%S'
+            },
+            'json_lines': {
+                'format': '%(message)s',
+            },
+        },
+        'root': {
+            'level': 'INFO',
+            'handlers': ['console'],
+        },
+        'loggers': {
+            # state changes are written as bare JSON lines, at the level
+            # they are logged at
+            'state': {
+                'level': getattr(args, 'state_log_level', 'INFO'),
+                'handlers': ['state'],
+                'propagate': False,
+            },
+        },
+    })
 
-if __name__ == '__main__':
-    import sys
-    import os
+    if env is None:
+        env = immutables.Map(dict(os.environ))
+    with profiling.profiling(args):
+        return args.func(args, env)
 
-    if os.path.isfile('.env'):
-        with open('.env') as f:
-            for line in f.read().split('\n'):
-                if line and not line.startswith('#'):
-                    k, v = line.split('=', 1)
-                    os.environ[k.rstrip()] = v.lstrip()
 
-    main(list(sys.argv[1:]))
+if __name__ == '__main__':
+    main(list(sys.argv[1:]), load_env())
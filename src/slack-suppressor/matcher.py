@@ -0,0 +1,201 @@
+"""Match many text rules against a message in a single pass
+
+A rule is a dict of a ``method`` and its ``arguments`` as written in
+``APP_ON_MESSAGE_CONF``, e.g. ``{"method": "startswith", "arguments": ["x"]}``
+matches a text ``t`` if ``t.startswith("x")`` is true.
+
+Literal rules, i.e. ``__contains__``, ``startswith``, ``endswith`` and
+``__eq__`` with a single string, are compiled into one Aho-Corasick
+automaton. ``search`` rules take a regular expression and are merged into a
+single pattern. Any other ``str`` method is still supported by calling it.
+"""
+from collections import deque
+import re
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+
+LITERAL_METHODS = frozenset([
+    '__contains__',
+    'startswith',
+    'endswith',
+    '__eq__',
+])
+REGEX_METHOD = 'search'
+
+#: numbered backreferences break once patterns are merged
+R_BACKREF = re.compile(r'\\[1-9]')
+#: the flags of a pattern without any global inline flag
+DEFAULT_FLAGS = re.compile('').flags
+
+
+class AhoCorasick:
+    """An Aho-Corasick automaton over a fixed list of patterns"""
+
+    def __init__(self, patterns: Iterable[str]) -> None:
+        self.patterns = list(patterns)
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Tuple[int, ...]] = [()]
+
+        for i, pattern in enumerate(self.patterns):
+            if not pattern:
+                raise ValueError('an empty pattern cannot be matched')
+            node = 0
+            for ch in pattern:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                    self._goto[node][ch] = nxt
+                node = nxt
+            self._out[node] += (i,)
+
+        # a breadth first walk guarantees that the node a failure link
+        # points to is complete before its outputs are merged
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] += self._out[self._fail[nxt]]
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, int]]:
+        """Yield ``(end, pattern index)`` of every occurrence in ``text``"""
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for index in out[node]:
+                yield i + 1, index
+
+
+class RuleMatcher:
+    """Rules compiled once and evaluated together"""
+
+    def __init__(self, rules: Sequence[Dict[str, Any]]) -> None:
+        self.rules = list(rules)
+
+        literals: Dict[str, int] = {}
+        #: (rule index, method) for each literal
+        literal_rules: List[List[Tuple[int, str]]] = []
+        regexes: List[Tuple[int, 're.Pattern[str]']] = []
+        self._fallbacks: List[Tuple[int, str, List[Any]]] = []
+
+        for i, rule in enumerate(self.rules):
+            method = rule['method']
+            arguments = list(rule.get('arguments', []))
+            if (
+                method in LITERAL_METHODS and
+                len(arguments) == 1 and
+                isinstance(arguments[0], str) and
+                arguments[0]
+            ):
+                literal = arguments[0]
+                if literal not in literals:
+                    literals[literal] = len(literal_rules)
+                    literal_rules.append([])
+                literal_rules[literals[literal]].append((i, method))
+            elif method == REGEX_METHOD:
+                (pattern,) = arguments
+                # fail fast on a broken pattern
+                regexes.append((i, re.compile(pattern)))
+            else:
+                if not callable(getattr(str, method, None)):
+                    raise ValueError(f'unknown method: {method}')
+                self._fallbacks.append((i, method, arguments))
+
+        self._automaton: Optional[AhoCorasick] = None
+        if literals:
+            self._automaton = AhoCorasick(literals)
+        self._literal_rules = literal_rules
+        self._literal_lengths = [len(literal) for literal in literals]
+
+        self._merged: Optional['re.Pattern[str]'] = None
+        self._merged_rules: List[int] = []
+        mergeable = [(i, p) for i, p in regexes if self._is_mergeable(p)]
+        if mergeable:
+            try:
+                # every rule is an optional lookahead, so one match at the
+                # beginning of a text tells all the patterns found in it
+                # (?s) is scoped to the skipped prefix, as a . of a rule
+                # does not match a newline on its own
+                self._merged = re.compile(''.join(
+                    f'(?=(?:(?s:.*?)(?P<r{n}>{p.pattern}))?)'
+                    for n, (_, p) in enumerate(mergeable)
+                ))
+            except re.error:
+                # e.g. too many groups; every pattern is searched alone
+                mergeable = []
+            else:
+                self._merged_rules = [i for i, _ in mergeable]
+        merged = {i for i, _ in mergeable}
+        self._regexes = [(i, p) for i, p in regexes if i not in merged]
+
+    @staticmethod
+    def _is_mergeable(pattern: 're.Pattern[str]') -> bool:
+        if (
+            # a global inline flag, e.g. (?i), would apply to every rule
+            pattern.flags != DEFAULT_FLAGS or
+            # the group names of the rules might collide, also with r<N>
+            pattern.groupindex or
+            R_BACKREF.search(pattern.pattern)
+        ):
+            return False
+        try:
+            re.compile(f'(?=(?:(?s:.*?)(?:{pattern.pattern}))?)')
+        except re.error:
+            return False
+        return True
+
+    def match(self, text: str) -> FrozenSet[int]:
+        """Return the indices of all the rules ``text`` matches"""
+        matched = set()
+
+        if self._automaton is not None:
+            length = len(text)
+            for end, index in self._automaton.iter_matches(text):
+                start = end - self._literal_lengths[index]
+                for i, method in self._literal_rules[index]:
+                    if (
+                        (method == '__contains__') or
+                        (method == 'startswith' and start == 0) or
+                        (method == 'endswith' and end == length) or
+                        (method == '__eq__' and start == 0 and end == length)
+                    ):
+                        matched.add(i)
+
+        if self._merged is not None:
+            m = self._merged.match(text)
+            for n, i in enumerate(self._merged_rules):
+                if m.group(f'r{n}') is not None:
+                    matched.add(i)
+
+        for i, pattern in self._regexes:
+            if pattern.search(text):
+                matched.add(i)
+
+        for i, method, arguments in self._fallbacks:
+            if getattr(text, method)(*arguments):
+                matched.add(i)
+
+        return frozenset(matched)
@@ -0,0 +1,371 @@
+"""Counters and latency histograms exposed in the Prometheus text format
+
+Only what the app needs is implemented: counters and histograms with
+labels, a registry rendering them, and a scrape endpoint served from a
+daemon thread, e.g.::
+
+  $ curl http://localhost:9090/metrics
+
+Every metric is guarded by its own lock since side effects are also run
+from timer threads.
+"""
+import asyncio
+from bisect import bisect_left
+import http.server
+import logging
+import threading
+import time
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'slack_suppressor_'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#: seconds; from a reducer call up to a round trip to Slack
+LATENCY_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0,
+)
+#: seconds; an event can be delayed by a reconnection
+LAG_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return (
+        value
+        .replace('\\', r'\\')
+        .replace('\n', r'\n')
+        .replace('"', r'\"')
+    )
+
+
+class _Metric:
+    type_ = ''
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _labels(
+        self,
+        labelvalues: Tuple[str, ...],
+        extra: Sequence[Tuple[str, str]] = (),
+    ) -> str:
+        pairs = list(zip(self.labelnames, labelvalues)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(
+            f'{k}="{_escape(str(v))}"' for k, v in pairs
+        ) + '}'
+
+    def _samples(self) -> Iterator[str]:
+        raise NotImplementedError()
+
+    def render(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.type_}'
+        yield from self._samples()
+
+
+class Counter(_Metric):
+    type_ = 'counter'
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labelvalues] = (
+                self._values.get(labelvalues, 0.0) + amount
+            )
+
+    def _samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for labelvalues, value in values:
+            labels = self._labels(labelvalues)
+            yield f'{self.name}{labels} {_format_value(value)}'
+
+
+class Gauge(Counter):
+    type_ = 'gauge'
+
+    def set(self, value: float, *labelvalues: str) -> None:
+        with self._lock:
+            self._values[labelvalues] = value
+
+
+class Histogram(_Metric):
+    type_ = 'histogram'
+
+    def __init__(
+        self,
+        *args,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        **kwargs,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        #: counts per bucket, not cumulative, followed by the sum
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labelvalues)
+            if counts is None:
+                counts = self._values[labelvalues] = (
+                    [0] * len(self.buckets) + [0.0]
+                )
+            counts[i] += 1
+            counts[-1] += value
+
+    def _samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted(
+                (labelvalues, list(counts))
+                for labelvalues, counts in self._values.items()
+            )
+        for labelvalues, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = self._labels(
+                    labelvalues,
+                    [('le', _format_value(bound))],
+                )
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = self._labels(labelvalues)
+            yield f'{self.name}_sum{labels} {_format_value(counts[-1])}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: List[_Metric] = []
+
+    def counter(self, name: str, *args, **kwargs) -> Counter:
+        return self._register(Counter(PREFIX + name, *args, **kwargs))
+
+    def gauge(self, name: str, *args, **kwargs) -> Gauge:
+        return self._register(Gauge(PREFIX + name, *args, **kwargs))
+
+    def histogram(self, name: str, *args, **kwargs) -> Histogram:
+        return self._register(Histogram(PREFIX + name, *args, **kwargs))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return ''.join(
+            line + '\n'
+            for metric in self._metrics
+            for line in metric.render()
+        )
+
+
+class AppMetrics:
+    """The metrics of the suppressor and the hooks to collect them"""
+
+    def __init__(self, registry: Optional[Registry] = None) -> None:
+        self.registry = registry or Registry()
+        r = self.registry
+        self.events = r.counter(
+            'events_total',
+            'RTM events received',
+            ['event'],
+        )
+        self.event_lag = r.histogram(
+            'event_lag_seconds',
+            'Seconds from an event being sent by Slack until it is received',
+            ['event'],
+            buckets=LAG_BUCKETS,
+        )
+        self.reducer_seconds = r.histogram(
+            'reducer_seconds',
+            'Seconds spent reducing an action',
+            ['action_type'],
+        )
+        self.reducer_errors = r.counter(
+            'reducer_errors_total',
+            'Actions whose reducer raised an exception',
+            ['action_type'],
+        )
+        self.dispatch_seconds = r.histogram(
+            'dispatch_seconds',
+            'Seconds spent dispatching an action through the middlewares',
+            ['action_type'],
+        )
+        self.subscriber_seconds = r.histogram(
+            'subscriber_seconds',
+            'Seconds spent in a subscriber, including its API calls',
+            ['subscriber'],
+        )
+        self.subscriber_errors = r.counter(
+            'subscriber_errors_total',
+            'Subscriber calls which raised an exception',
+            ['subscriber'],
+        )
+        self.effect_seconds = r.histogram(
+            'effect_seconds',
+            'Seconds spent in a side effect run off the message path',
+            ['effect'],
+        )
+        self.effect_errors = r.counter(
+            'effect_errors_total',
+            'Side effects which raised an exception or were dropped',
+            ['effect'],
+        )
+        self.api_seconds = r.histogram(
+            'api_call_seconds',
+            'Seconds spent in an API call',
+            ['client', 'method'],
+        )
+        self.api_errors = r.counter(
+            'api_call_errors_total',
+            'API calls which failed or were not ok',
+            ['client', 'method'],
+        )
+        self.api_queue_depth = r.gauge(
+            'api_queue_depth',
+            'API calls waiting in the scheduler',
+            ['priority'],
+        )
+        self.api_queue_seconds = r.histogram(
+            'api_queue_seconds',
+            'Seconds an API call waited in the scheduler',
+            ['method'],
+            buckets=LAG_BUCKETS,
+        )
+        self.api_rate_limited = r.counter(
+            'api_rate_limited_total',
+            'API calls answered with 429 Too Many Requests',
+            ['method'],
+        )
+        self.api_dropped = r.counter(
+            'api_calls_dropped_total',
+            'API calls never sent, superseded by a newer one or over the queue limit',  # noqa: E501
+            ['method', 'reason'],
+        )
+
+    def received(self, event: str, payload: Dict[str, Any]) -> None:
+        self.events.inc(event)
+        data = payload.get('data') or {}
+        sent_at = data.get('event_ts') or data.get('ts')
+        if sent_at:
+            # the clocks may be a little bit off
+            lag = max(0.0, time.time() - float(sent_at))
+            self.event_lag.observe(lag, event)
+        web_client = payload.get('web_client')
+        if web_client is not None:
+            self.instrument_web_client(web_client)
+
+    def api_called(
+        self,
+        client: str,
+        method: str,
+        started_at: float,
+        ok: bool,
+    ) -> None:
+        self.api_seconds.observe(time.perf_counter() - started_at, client, method)  # noqa: E501
+        if not ok:
+            self.api_errors.inc(client, method)
+
+    def instrument_web_client(self, web_client) -> None:
+        """Time every call of a :class:`slack.WebClient`
+
+        Every ``chat_postMessage`` and the like goes through ``api_call``,
+        so it is wrapped once per client.
+        """
+        if getattr(web_client, '_metrics', None) is self:
+            return
+        api_call = web_client.api_call
+
+        def _api_call(api_method: str, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                response = api_call(api_method, **kwargs)
+            except Exception:
+                self.api_called('web_api', api_method, started_at, False)
+                raise
+
+            if asyncio.isfuture(response):
+                response.add_done_callback(lambda f: self.api_called(
+                    'web_api',
+                    api_method,
+                    started_at,
+                    not f.cancelled() and f.exception() is None,
+                ))
+            else:
+                self.api_called('web_api', api_method, started_at, True)
+            return response
+
+        web_client.api_call = _api_call
+        web_client._metrics = self
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        logger.debug(format, *args)
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """Serve ``/metrics`` next to the RTM client"""
+
+    daemon_threads = True
+
+    def __init__(self, registry: Registry, host: str, port: int) -> None:
+        super().__init__((host, port), _Handler)
+        self.registry = registry
+        self._thread = threading.Thread(
+            target=self.serve_forever,
+            name='metrics',
+            daemon=True,
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+        logger.info(
+            'serving metrics: address=%s:%d',
+            *self.server_address[:2],
+        )
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,182 @@
+"""Profilers switched on by the command line options
+
+The suppressor can be profiled in place, e.g. in a production pod::
+
+  $ python main.py --profile-sample stacks.txt suppress
+  $ flamegraph.pl stacks.txt > stacks.svg
+
+cProfile only sees the main thread, which runs the event loop handling the
+events; the API workers and the backfiller show up in the samples. With
+``--processes`` above 1 the shards are not profiled.
+"""
+import argparse
+from collections import Counter
+import contextlib
+import cProfile
+import io
+import logging
+import pstats
+import sys
+import threading
+import tracemalloc
+from typing import Iterator, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--profile',
+        metavar='PATH',
+        help='write cProfile stats of the main thread to PATH on exit',
+    )
+    parser.add_argument(
+        '--trace-malloc',
+        metavar='N',
+        default=0,
+        type=int,
+        help='log the N lines which allocated the most at intervals',
+    )
+    parser.add_argument(
+        '--trace-malloc-interval',
+        metavar='SECONDS',
+        default=60.0,
+        type=float,
+    )
+    parser.add_argument(
+        '--profile-sample',
+        metavar='PATH',
+        help=(
+            'sample the stacks of every thread at intervals and write them '
+            'to PATH on exit, as an input of flamegraph.pl'
+        ),
+    )
+    parser.add_argument(
+        '--profile-sample-interval',
+        metavar='SECONDS',
+        default=0.01,
+        type=float,
+    )
+
+
+class MallocTracer(threading.Thread):
+    """Log the lines which allocated the most since the last time"""
+
+    def __init__(self, top: int, interval: float) -> None:
+        super().__init__(name='trace-malloc', daemon=True)
+        self.top = top
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._last: Optional[tracemalloc.Snapshot] = None
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.log()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.join()
+        self.log()
+
+    def log(self) -> None:
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ])
+        if self._last is None:
+            stats = snapshot.statistics('lineno')
+        else:
+            stats = snapshot.compare_to(self._last, 'lineno')
+        self._last = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        logger.info('traced memory: current=%d, peak=%d', current, peak)
+        for stat in stats[:self.top]:
+            logger.info('%s', stat)
+
+
+class StackSampler(threading.Thread):
+    """Count the stacks of the other threads at intervals
+
+    Nothing runs between the samples, so that it costs far less than
+    cProfile. The counts are written in the collapsed format of
+    ``flamegraph.pl``.
+    """
+
+    def __init__(self, path: str, interval: float) -> None:
+        super().__init__(name='profile-sample', daemon=True)
+        self.path = path
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.join()
+        with open(self.path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        logger.info(
+            'the stacks have been written: path=%s, samples=%d',
+            self.path,
+            sum(self.stacks.values()),
+        )
+
+    def sample(self) -> None:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f'{code.co_name} '
+                    f'({code.co_filename}:{code.co_firstlineno})',
+                )
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[';'.join(reversed(stack))] += 1
+
+
+def _dump_profile(profile: cProfile.Profile, path: str) -> None:
+    profile.disable()
+    profile.dump_stats(path)
+    stream = io.StringIO()
+    stats = pstats.Stats(profile, stream=stream)
+    stats.sort_stats('cumulative').print_stats(20)
+    logger.info(
+        'the profile has been written: path=%s\n%s',
+        path,
+        stream.getvalue(),
+    )
+
+
+@contextlib.contextmanager
+def profiling(args: argparse.Namespace) -> Iterator[None]:
+    """Run the profilers asked for by the options while in the context"""
+    with contextlib.ExitStack() as stack:
+        if args.trace_malloc > 0:
+            tracemalloc.start()
+            stack.callback(tracemalloc.stop)
+            tracer = MallocTracer(
+                args.trace_malloc,
+                args.trace_malloc_interval,
+            )
+            tracer.start()
+            stack.callback(tracer.stop)
+        if args.profile_sample is not None:
+            sampler = StackSampler(
+                args.profile_sample,
+                args.profile_sample_interval,
+            )
+            sampler.start()
+            stack.callback(sampler.stop)
+        if args.profile is not None:
+            profile = cProfile.Profile()
+            stack.callback(_dump_profile, profile, args.profile)
+            profile.enable()
+        yield
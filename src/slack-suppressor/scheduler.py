@@ -0,0 +1,541 @@
+"""Schedule outbound API calls within the rate limits of Slack
+
+Every method is given a token bucket refilled at the rate of its tier, see
+https://api.slack.com/docs/rate-limits. Calls wait in a queue per method
+and, whenever a bucket has a token, the waiting call with the highest
+priority is sent first, e.g. a reaction a user is waiting for goes ahead of
+bulk marks.
+
+A call submitted with a ``key`` replaces the one of the same method and key
+still waiting, e.g. a newer mark of a channel supersedes the older one, so
+a backlog never sends anything stale. Each method queues at most
+``max_queue`` calls; a call beyond that fails with :class:`QueueFull`.
+
+``rtm.connect`` and ``rtm.start`` are sent right away instead. The RTM
+client calls them to reconnect, on the thread of its event loop, where a
+wait for the bucket of their tier would hold up everything else.
+
+A call answered with 429 Too Many Requests is sent again after the
+``Retry-After`` seconds and a random jitter. The method is paused for
+that long, so the calls behind it do not hit the limit again. The other
+failures are not retried since a message could be posted twice.
+"""
+import asyncio
+import concurrent.futures
+import dataclasses
+import enum
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+)
+
+from metrics import AppMetrics
+
+
+logger = logging.getLogger(__name__)
+
+#: calls per minute, and calls allowed at once, of each tier
+TIERS = {
+    1: (1, 1),
+    2: (20, 5),
+    3: (50, 15),
+    4: (100, 30),
+    # chat.postMessage allows a message per second
+    'special': (60, 5),
+}
+METHOD_TIERS = {
+    'chat.postMessage': 'special',
+    'conversations.history': 3,
+    'conversations.mark': 3,
+    'reactions.add': 3,
+    'subscriptions.thread.mark': 3,
+    'usergroups.users.list': 2,
+    'users.prefs.get': 3,
+}
+DEFAULT_TIER = 3
+#: methods never queued
+UNSCHEDULED_METHODS = frozenset(['rtm.connect', 'rtm.start'])
+
+PRIORITIES = enum.IntEnum('PRIORITIES', [
+    # a user sees the result
+    'USER',
+    # a user waits for another call behind it
+    'LOOKUP',
+    'BULK',
+])
+METHOD_PRIORITIES = {
+    'chat.postMessage': PRIORITIES.USER,
+    'conversations.history': PRIORITIES.BULK,
+    'conversations.mark': PRIORITIES.BULK,
+    'reactions.add': PRIORITIES.USER,
+    'subscriptions.thread.mark': PRIORITIES.BULK,
+}
+DEFAULT_PRIORITY = PRIORITIES.LOOKUP
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _header(headers: Any, name: str) -> Optional[str]:
+    if not headers:
+        return None
+    value = headers.get(name)
+    if value is None:
+        # the headers of a SlackResponse are a plain dict
+        for k, v in headers.items():
+            if k.lower() == name.lower():
+                return v
+    return value
+
+
+def retry_after_of(outcome: Any) -> Optional[float]:
+    """Return the seconds to wait if a response or an error tells 429
+
+    Both a response, e.g. :class:`requests.Response`, and an exception with
+    one, e.g. :class:`slack.errors.SlackApiError`, are accepted.
+    """
+    response = getattr(outcome, 'response', outcome)
+    if getattr(response, 'status_code', None) != 429:
+        return None
+    value = _header(getattr(response, 'headers', None), 'Retry-After')
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        # a 429 without the header
+        return 1.0
+
+
+class TokenBucket:
+    def __init__(
+        self,
+        rate: float,
+        capacity: int,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        #: tokens per second
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = float(capacity)
+        self._updated_at = clock()
+        self._paused_until = 0.0
+
+    @classmethod
+    def of_tier(
+        cls,
+        tier,
+        tiers: Mapping[Any, Tuple[float, int]] = TIERS,
+        **kwargs,
+    ) -> 'TokenBucket':
+        per_minute, capacity = tiers[tier]
+        return cls(per_minute / 60, capacity, **kwargs)
+
+    def _refill(self, now: float) -> None:
+        if now <= self._updated_at:
+            # paused
+            return
+        self._tokens = min(
+            self.capacity,
+            self._tokens + (now - self._updated_at) * self.rate,
+        )
+        self._updated_at = now
+
+    def delay(self) -> float:
+        """Seconds until a token is available"""
+        now = self._clock()
+        self._refill(now)
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def take(self) -> None:
+        self._tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens, e.g. as told by ``Retry-After``"""
+        now = self._clock()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0.0
+        self._updated_at = self._paused_until
+
+
+@dataclasses.dataclass
+class _Job:
+    priority: int
+    #: keeps the submitted order within a priority, even after a retry
+    seq: int
+    method: str
+    fn: Callable[..., Any]
+    args: Tuple[Any, ...]
+    kwargs: Dict[str, Any]
+    future: Any
+    submitted_at: float
+    key: Optional[Hashable] = None
+    not_before: float = 0.0
+    attempts: int = 0
+    started: bool = False
+
+    def __lt__(self, other: '_Job') -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _BaseApiScheduler:
+    """Things shared between the schedulers
+
+    Jobs are only touched while the subclasses hold their lock, or from the
+    event loop.
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        max_retries: int = 3,
+        jitter: float = 1.0,
+        metrics: Optional[AppMetrics] = None,
+        clock: Callable[[], float] = time.monotonic,
+        max_queue: int = 1000,
+        tiers: Mapping[Any, Tuple[float, int]] = TIERS,
+    ) -> None:
+        self.workers = workers
+        self.max_retries = max_retries
+        self.max_queue = max_queue
+        self.jitter = jitter
+        self.metrics = metrics
+        #: e.g. higher limits than those of Slack for a benchmark
+        self.tiers = tiers
+        self._clock = clock
+        self._seq = itertools.count()
+        #: a heap of jobs per method
+        self._queues: Dict[str, List[_Job]] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        #: the queued job of each ``(method, key)``
+        self._keyed: Dict[Tuple[str, Hashable], _Job] = {}
+        self._depth: Dict[int, int] = {p: 0 for p in PRIORITIES}
+
+    @property
+    def depth(self) -> int:
+        """The number of calls waiting"""
+        return sum(self._depth.values())
+
+    def _bucket(self, method: str) -> TokenBucket:
+        bucket = self._buckets.get(method)
+        if bucket is None:
+            bucket = self._buckets[method] = TokenBucket.of_tier(
+                METHOD_TIERS.get(method, DEFAULT_TIER),
+                tiers=self.tiers,
+                clock=self._clock,
+            )
+        return bucket
+
+    def _enqueue(self, method, key, fn, args, kwargs, future) -> None:
+        """Queue a call, or let it take over the waiting one of its key"""
+        queued = None if key is None else self._keyed.get((method, key))
+        if queued is not None and not queued.started:
+            # the older call keeps its place in the queue
+            superseded, queued.future = queued.future, future
+            queued.fn, queued.args, queued.kwargs = fn, args, kwargs
+            superseded.cancel()
+            self._dropped(method, 'superseded')
+            return
+
+        if len(self._queues.get(method, ())) >= self.max_queue:
+            self._dropped(method, 'queue_full')
+            future.set_exception(QueueFull(f'{method}: {self.max_queue}'))
+            return
+
+        self._push(_Job(
+            priority=METHOD_PRIORITIES.get(method, DEFAULT_PRIORITY),
+            seq=next(self._seq),
+            method=method,
+            fn=fn,
+            args=args,
+            kwargs=kwargs,
+            future=future,
+            submitted_at=self._clock(),
+            key=key,
+        ))
+
+    def _dropped(self, method: str, reason: str) -> None:
+        if self.metrics is not None:
+            self.metrics.api_dropped.inc(method, reason)
+
+    def _push(self, job: _Job) -> None:
+        heapq.heappush(self._queues.setdefault(job.method, []), job)
+        if job.key is not None:
+            self._keyed[(job.method, job.key)] = job
+        self._count(job, 1)
+
+    def _count(self, job: _Job, n: int) -> None:
+        self._depth[job.priority] += n
+        if self.metrics is not None:
+            self.metrics.api_queue_depth.set(
+                self._depth[job.priority],
+                PRIORITIES(job.priority).name,
+            )
+
+    def _pop_ready(self) -> Tuple[Optional[_Job], Optional[float]]:
+        """Pop the best job which can be sent now
+
+        Otherwise return the seconds until one can be, or None if nothing
+        is waiting.
+        """
+        now = self._clock()
+        best: Optional[_Job] = None
+        wait: Optional[float] = None
+        for method, queue in self._queues.items():
+            if not queue:
+                continue
+            head = queue[0]
+            delay = max(
+                self._bucket(method).delay(),
+                head.not_before - now,
+            )
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+            elif best is None or head < best:
+                best = head
+
+        if best is None:
+            return None, wait
+
+        heapq.heappop(self._queues[best.method])
+        if best.key is not None:
+            key = (best.method, best.key)
+            if self._keyed.get(key) is best:
+                del self._keyed[key]
+        self._count(best, -1)
+        self._bucket(best.method).take()
+        if self.metrics is not None and best.attempts == 0:
+            self.metrics.api_queue_seconds.observe(
+                now - best.submitted_at,
+                best.method,
+            )
+        return best, None
+
+    def _retry(self, job: _Job, retry_after: float) -> bool:
+        """Queue a job again if it is rate limited and can be retried"""
+        if self.metrics is not None:
+            self.metrics.api_rate_limited.inc(job.method)
+        self._bucket(job.method).pause(retry_after)
+        if job.attempts >= self.max_retries:
+            logger.error(
+                'rate limited too many times: method=%s, attempts=%d',
+                job.method,
+                job.attempts + 1,
+            )
+            return False
+
+        job.attempts += 1
+        job.not_before = (
+            self._clock() + retry_after + random.uniform(0, self.jitter)
+        )
+        logger.warning(
+            'rate limited: method=%s, retry_after=%s, attempts=%d',
+            job.method,
+            retry_after,
+            job.attempts,
+        )
+        self._push(job)
+        return True
+
+
+class ApiScheduler(_BaseApiScheduler):
+    """Send calls from a pool of worker threads
+
+    :meth:`submit` returns a :class:`concurrent.futures.Future`.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._threads = [
+            threading.Thread(
+                target=self._work,
+                name=f'api-{i}',
+                daemon=True,
+            )
+            for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(
+        self,
+        method: str,
+        fn: Callable[..., Any],
+        *args,
+        key: Optional[Hashable] = None,
+        **kwargs,
+    ) -> 'concurrent.futures.Future[Any]':
+        future: 'concurrent.futures.Future[Any]' = concurrent.futures.Future()
+        with self._cond:
+            self._enqueue(method, key, fn, args, kwargs, future)
+            self._cond.notify()
+        return future
+
+    def call(self, method: str, fn: Callable[..., Any], *args, **kwargs):
+        """Submit a call and wait for its result
+
+        It waits for the rate limit too, so that it must not be called on
+        the thread of the RTM client's event loop.
+        """
+        return self.submit(method, fn, *args, **kwargs).result()
+
+    def wrap_web_client(self, web_client) -> None:
+        """Send every call of a :class:`slack.WebClient` through here"""
+        if getattr(web_client, '_scheduler', None) is self:
+            return
+        api_call = web_client.api_call
+
+        def scheduled(api_method: str, **kwargs):
+            if api_method in UNSCHEDULED_METHODS:
+                return api_call(api_method, **kwargs)
+            return self.call(api_method, api_call, api_method, **kwargs)
+
+        web_client.api_call = scheduled
+        web_client._scheduler = self
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    job, wait = self._pop_ready()
+                    if job is not None:
+                        break
+                    if wait is None and self._stopping:
+                        return
+                    self._cond.wait(wait)
+
+            if not job.started:
+                if not job.future.set_running_or_notify_cancel():
+                    continue
+                job.started = True
+            try:
+                result = job.fn(*job.args, **job.kwargs)
+            except Exception as e:
+                outcome: Any = e
+                retry_after = retry_after_of(e)
+            else:
+                outcome = result
+                retry_after = retry_after_of(result)
+
+            if retry_after is not None:
+                with self._cond:
+                    retried = self._retry(job, retry_after)
+                    self._cond.notify_all()
+                if retried:
+                    continue
+
+            if isinstance(outcome, Exception):
+                job.future.set_exception(outcome)
+            else:
+                job.future.set_result(outcome)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Send the calls already submitted, then stop the workers"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+
+class AsyncApiScheduler(_BaseApiScheduler):
+    """Send calls from worker tasks on the event loop
+
+    :meth:`submit` returns an :class:`asyncio.Future`, and ``fn`` has to
+    return an awaitable.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._wakeup = asyncio.Event()
+        self._tasks: List['asyncio.Task[None]'] = []
+        self._running = 0
+
+    def start(self) -> None:
+        self._tasks = [
+            asyncio.ensure_future(self._work()) for _ in range(self.workers)
+        ]
+
+    def submit(
+        self,
+        method: str,
+        fn: Callable[..., Any],
+        *args,
+        key: Optional[Hashable] = None,
+        **kwargs,
+    ) -> 'asyncio.Future[Any]':
+        future = asyncio.get_event_loop().create_future()
+        self._enqueue(method, key, fn, args, kwargs, future)
+        self._wakeup.set()
+        return future
+
+    def wrap_web_client(self, web_client) -> None:
+        """Send every call of a :class:`slack.WebClient` through here"""
+        if getattr(web_client, '_scheduler', None) is self:
+            return
+        api_call = web_client.api_call
+
+        def scheduled(api_method: str, **kwargs):
+            if api_method in UNSCHEDULED_METHODS:
+                return api_call(api_method, **kwargs)
+            return self.submit(api_method, api_call, api_method, **kwargs)
+
+        web_client.api_call = scheduled
+        web_client._scheduler = self
+
+    async def _work(self) -> None:
+        while True:
+            job, wait = self._pop_ready()
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if job.future.cancelled():
+                continue
+            self._running += 1
+            try:
+                outcome = await job.fn(*job.args, **job.kwargs)
+            except Exception as e:
+                outcome = e
+            finally:
+                self._running -= 1
+
+            retry_after = retry_after_of(outcome)
+            if retry_after is not None and self._retry(job, retry_after):
+                self._wakeup.set()
+                continue
+            if job.future.cancelled():
+                continue
+            if isinstance(outcome, Exception):
+                job.future.set_exception(outcome)
+            else:
+                job.future.set_result(outcome)
+
+    async def close(self) -> None:
+        """Send the calls already submitted, then stop the workers"""
+        while self.depth or self._running:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
@@ -0,0 +1,50 @@
+"""A snapshot of the app state for a warm restart
+
+A snapshot is a file which starts with :data:`MAGIC` followed by compact
+JSON compressed with zlib. Channel ids and timestamps compress well, so
+10000 channels take less than 100KB.
+
+A snapshot is written to a temporary file which then replaces the previous
+one, so that a crash while writing never leaves a broken snapshot behind.
+"""
+import json
+import os
+import zlib
+from typing import Any
+
+
+MAGIC = b'RTMS\x00\x01'
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def write_snapshot(path: str, data: Any) -> int:
+    """Replace the snapshot at ``path`` and return its size in bytes"""
+    body = zlib.compress(
+        json.dumps(
+            data,
+            ensure_ascii=False,
+            separators=(',', ':'),
+        ).encode('utf-8'),
+    )
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(MAGIC) + len(body)
+
+
+def read_snapshot(path: str) -> Any:
+    with open(path, 'rb') as f:
+        content = f.read()
+    if content[:len(MAGIC)] != MAGIC:
+        raise SnapshotError(f'not a snapshot: {path}')
+    try:
+        return json.loads(zlib.decompress(content[len(MAGIC):]))
+    except (zlib.error, ValueError) as e:
+        raise SnapshotError(f'a broken snapshot: {path}') from e
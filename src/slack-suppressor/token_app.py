@@ -1,10 +1,15 @@
 import os
 
+from html import escape
+
 from flask import (
     Flask,
     request,
 )
-import slack
+import requests
+from requests.adapters import HTTPAdapter
+
+from tokenstore import TokenStore, TokenStoreError
 
 app = Flask(__name__)
 
@@ -12,6 +17,25 @@ app = Flask(__name__)
 OAUTH_SCOPE = 'client'
 CLIENT_ID = os.environ['SLACK_CLIENT_ID']
 CLIENT_SECRET = os.environ['SLACK_CLIENT_SECRET']
+SLACK_API_URL = os.environ.get('SLACK_API_URL', 'https://slack.com/api/')
+#: seconds a user has to submit the web app session after the OAuth exchange
+TICKET_TTL = 600
+
+#: shared by the requests handled concurrently so that the connections to
+#: Slack are pooled instead of being opened per exchange
+adapter = HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=int(os.environ.get('APP_TOKEN_POOL_SIZE', '10')),
+)
+session = requests.Session()
+session.mount('https://', adapter)
+session.mount('http://', adapter)
+
+#: read by ``main.py suppress --token-store`` at startup
+store = TokenStore(
+    os.environ.get('APP_TOKEN_STORE', 'tokens.bin'),
+    os.environ['APP_TOKEN_STORE_KEY'],
+)
 
 
 @app.route("/begin", methods=["GET"])
@@ -28,9 +52,48 @@ def begin():
 @app.route('/token')
 def token():
     code = request.args['code']
-    token = slack.WebClient(token='').oauth_access(
-        client_id=CLIENT_ID,
-        client_secret=CLIENT_SECRET,
-        code=code,
-    )['access_token']
-    return '\n'.join([f'code: {code}', f'token: {token}'])
+    response = session.post(
+        SLACK_API_URL.rstrip('/') + '/oauth.access',
+        data={
+            'client_id': CLIENT_ID,
+            'client_secret': CLIENT_SECRET,
+            'code': code,
+        },
+        timeout=10,
+    ).json()
+    if not response['ok']:
+        return f'failed to exchange the code: {response["error"]}', 400
+
+    # the user id is unique and safe in a file name like --journal
+    name = response['user_id']
+    store.put(name, {'SLACK_USER_ACCESS_TOKEN': response['access_token']})
+    # the web app session cannot be had through OAuth, so that the user
+    # gives their own; the account is not run until then
+    return f'''
+    <p>the token of {escape(name)} has been stored</p>
+    <form action="/web-app" method="POST">
+        <input type="hidden" name="ticket" value="{store.ticket(name)}" />
+        <input type="text" name="base_url" placeholder="https://example.slack.com" />
+        <input type="password" name="cookie" placeholder="d=..." />
+        <input type="password" name="token" placeholder="xoxc-..." />
+        <input type="submit" />
+    </form>
+    '''  # noqa: E501
+
+
+@app.route('/web-app', methods=['POST'])
+def web_app():
+    try:
+        name = store.redeem(request.form['ticket'], ttl=TICKET_TTL)
+    except TokenStoreError as e:
+        return str(e), 403
+
+    conf = {
+        'SLACK_WEB_APP_BASE_URL': request.form['base_url'].strip(),
+        'SLACK_WEB_APP_COOKIE': request.form['cookie'].strip(),
+        'SLACK_WEB_APP_TOKEN': request.form['token'].strip(),
+    }
+    if not all(conf.values()):
+        return 'every field of the web app session is required', 400
+    store.put(name, conf)
+    return f'the web app session of {escape(name)} has been stored'
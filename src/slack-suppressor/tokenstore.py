@@ -0,0 +1,116 @@
+"""An encrypted file of the accounts onboarded through token_app
+
+The file holds a JSON list of objects like the ones of ``--accounts``, i.e.
+``name`` and the environment variables of the account, encrypted with
+Fernet (AES-128-CBC and HMAC-SHA256) under ``APP_TOKEN_STORE_KEY``. A key is
+made by::
+
+  $ python -c 'from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())'
+
+An account is complete only once its own web app session, i.e.
+:data:`WEB_APP_ENV`, is stored along with the token; the suppressor never
+fills them in from its environment, which holds a single user's session.
+
+The file is replaced atomically like a snapshot, and every read-modify-write
+holds an exclusive lock on ``<path>.lock``, so that concurrent OAuth
+exchanges, in threads or in processes, never lose an account.
+"""  # noqa: E501
+import contextlib
+import fcntl
+import json
+import os
+from typing import Any, Dict, Iterator, List
+
+from cryptography.fernet import Fernet, InvalidToken
+
+
+#: the variables every stored account has to have of its own
+WEB_APP_ENV = (
+    'SLACK_WEB_APP_COOKIE',
+    'SLACK_WEB_APP_TOKEN',
+    'SLACK_WEB_APP_BASE_URL',
+)
+
+
+class TokenStoreError(Exception):
+    pass
+
+
+class TokenStore:
+
+    def __init__(self, path: str, key: str) -> None:
+        self.path = path
+        try:
+            self._fernet = Fernet(key)
+        except ValueError as e:
+            raise TokenStoreError(f'a malformed key: {e}') from e
+
+    @contextlib.contextmanager
+    def _locked(self, shared: bool = False) -> Iterator[None]:
+        with open(f'{self.path}.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read(self) -> List[Dict[str, Any]]:
+        try:
+            with open(self.path, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return []
+        try:
+            return json.loads(self._fernet.decrypt(content))
+        except InvalidToken as e:
+            raise TokenStoreError(
+                f'a wrong key or a broken store: {self.path}',
+            ) from e
+
+    def _write(self, accounts: List[Dict[str, Any]]) -> None:
+        body = self._fernet.encrypt(
+            json.dumps(
+                accounts,
+                ensure_ascii=False,
+                separators=(',', ':'),
+            ).encode('utf-8'),
+        )
+        tmp_path = f'{self.path}.tmp'
+        # the tokens are readable by nobody else even while encrypted
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'wb') as f:
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def ticket(self, name: str) -> str:
+        """An opaque proof that whoever holds it has onboarded ``name``"""
+        return self._fernet.encrypt(name.encode('utf-8')).decode('ascii')
+
+    def redeem(self, ticket: str, ttl: int) -> str:
+        """The name of a ticket issued in the last ``ttl`` seconds"""
+        try:
+            return self._fernet.decrypt(
+                ticket.encode('ascii'),
+                ttl=ttl,
+            ).decode('utf-8')
+        except (InvalidToken, UnicodeError) as e:
+            raise TokenStoreError('an invalid or expired ticket') from e
+
+    def load(self) -> List[Dict[str, Any]]:
+        """Every account in the order they were first stored"""
+        with self._locked(shared=True):
+            return self._read()
+
+    def put(self, name: str, conf: Dict[str, str]) -> None:
+        """Add an account, or update the variables of a stored one"""
+        with self._locked():
+            accounts = self._read()
+            for account in accounts:
+                if account['name'] == name:
+                    account.update(conf)
+                    break
+            else:
+                accounts.append({'name': name, **conf})
+            self._write(accounts)